@@ -0,0 +1,634 @@
+#!/usr/bin/env python
+"""Benchmarks of the junthelper routines. Run this file to execute all of them"""
+
+import random
+import time
+import subprocess
+import sys
+import os
+import tempfile
+import threading
+import statistics
+import json
+import platform
+import argparse
+import resource
+import multiprocessing
+import sqlite3
+import numpy as np
+
+import juntdb
+import scorer
+import pagescraper
+import lib
+import mockboard
+from lxml import html
+
+
+def best_time(fct, *args, repeat=3, **kwargs):
+    """Times a function call
+    fct:    function to time
+    repeat: number of times the call is repeated. Default is 3
+
+    returns: (best time in seconds, output of the last call)"""
+    best = float('inf')
+    for k in range(repeat):
+        start = time.perf_counter()
+        out = fct(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+def build_token_corpus(n_postings, n_tokens=400, hit_rate=0.02, seed=0):
+    """Builds synthetic processed_tokens strings out of linuxwords and the scorefile alternatives
+    n_postings: number of strings to build
+    n_tokens:   number of tokens per string. Default is 400
+    hit_rate:   probability that a token is replaced by a scorefile alternative. Default is 0.02
+    seed:       random seed. Default is 0
+
+    returns: list of strings"""
+    rng = random.Random(seed)
+    vocab = sorted(scorer.LINUX_WORDS)
+    alternatives = [alt for entry in scorer.REGEX_LIST for alt in entry[3] if alt]
+    corpus = []
+    for k in range(n_postings):
+        tokens = [rng.choice(alternatives) if rng.random() < hit_rate else rng.choice(vocab).lower()\
+                  for _ in range(n_tokens)]
+        corpus.append(' '.join(tokens) + ' ')
+    return corpus
+
+def bench_score(n_postings=500):
+    """Compares scorer.score against the per-row regex loop
+    n_postings: number of synthetic postings to score. Default is 500"""
+    corpus = build_token_corpus(n_postings)
+
+    t_row, out_row = best_time(lambda: [scorer.score_per_row(x) for x in corpus])
+    t_new, out_new = best_time(lambda: [scorer.score(x) for x in corpus])
+    if out_row != out_new:
+        raise Exception('scorer.score and scorer.score_per_row disagree')
+
+    print('score: ' + str(n_postings) + ' postings, ' + str(len(scorer.REGEX_LIST)) + ' scorefile rows')
+    print('  per row regex:  %.3fs' % t_row)
+    print('  rule matcher:   %.3fs (x%.1f)' % (t_new, t_row/t_new))
+
+def bench_matrix(n_postings=5000):
+    """Compares rescoring a corpus with scorer.score against a product of its scorer.RuleMatrix with the row weights
+    n_postings: number of synthetic postings to score. Default is 5000"""
+    corpus = build_token_corpus(n_postings)
+
+    t_score, out_score = best_time(lambda: [scorer.score(x) for x in corpus])
+    t_encode, matrix = best_time(scorer.RuleMatrix, corpus, repeat=1)
+    t_matrix, out_matrix = best_time(matrix.scores)
+    if [x[0] for x in out_score] != out_matrix.tolist() or [x[1] for x in out_score] != matrix.hit_lists():
+        raise Exception('scorer.score and scorer.RuleMatrix disagree')
+
+    print('corpus rescoring: ' + str(n_postings) + ' postings, ' + str(len(scorer.REGEX_LIST)) + ' scorefile rows')
+    print('  score per posting:   %.3fs' % t_score)
+    print('  matrix encoding:     %.3fs, %d bytes' % (t_encode, matrix.bits.nbytes))
+    print('  matrix reweighting:  %.4fs (x%.0f)' % (t_matrix, t_score/t_matrix))
+
+# Words that the tokenizers treat specially: entities, ascii and unicode punctuation, dashes and contractions
+SPECIAL_WORDS = ['R&amp;D', '&lt;5 years', 'C++', 'e-mail', '“quoted”', '‘single’', '«chevrons»', '2012–2016', 'now—later',\
+                 'cannot', 'gonna', 'wanna', 'gotta', 'lemme', "don't", "team's", '$80,000', '(remote)', 'Q&amp;A', '…', '•']
+
+# Endings of the golden corpus pages that the html parser of preprocess_bodystring only flushes when it is closed
+EDGE_ENDINGS = ['R&amp;D', 'AT&amp;T', 'Q&amp;A.', '&lt;5 years', 'x &lt; y', 'x &gt; y', '&amp;', '&lt;', 'fish &amp; chips',\
+                '</p>tail text', '<br>', '<br/>end', '<span>unclosed', '&nbsp;', '&eacute;t&eacute;']
+
+def build_paragraphs(rng, n_paragraphs):
+    """Builds the html paragraphs of a synthetic job posting, out of linuxwords, the scorefile terms and module.SPECIAL_WORDS
+    rng:          random.Random instance
+    n_paragraphs: number of paragraphs
+
+    returns: list of html strings"""
+    vocab = sorted(scorer.LINUX_WORDS)
+    with open(scorer.SCOREFILE) as f:
+        terms = [alt.strip() for line in f if line.strip() and line[0] != '#' for alt in line.split(',')[0].split('|')]
+    paragraphs = []
+    for p in range(n_paragraphs):
+        words = []
+        for w in range(rng.randint(20, 80)):
+            x = rng.random()
+            if x < 0.05:
+                words.append(rng.choice(terms))
+            elif x < 0.08:
+                words.append(rng.choice(SPECIAL_WORDS))
+            else:
+                word = rng.choice(vocab)
+                words.append(word + rng.choice(['', '', '', '', ',', '.', ':', ';', '!', '?']))
+        tag = rng.choice(['p', 'li', 'div'])
+        paragraphs.append('<' + tag + '>' + ' '.join(words) + '</' + tag + '>')
+    return paragraphs
+
+def build_html_corpus(n_pages, n_paragraphs=8, seed=0):
+    """Builds synthetic job posting pages
+    n_pages:      number of pages to build
+    n_paragraphs: number of paragraphs per page. Default is 8
+    seed:         random seed. Default is 0
+
+    returns: list of html strings"""
+    rng = random.Random(seed)
+    pages = []
+    for k in range(n_pages):
+        paragraphs = build_paragraphs(rng, n_paragraphs)
+        # Every few pages ends on an entity or markup
+        if k % 10 == 0:
+            paragraphs[-1] = paragraphs[-1][:paragraphs[-1].rindex('</')] + ' ' + EDGE_ENDINGS[(k//10) % len(EDGE_ENDINGS)]
+        pages.append('<html><head><title>Job ' + str(k) + '</title></head><body><h1>Job posting</h1>' +\
+                     ''.join(paragraphs) + '</body></html>')
+    return pages
+
+def build_bodystrings(pages):
+    """Extracts the bodystrings of html pages, as pagescraper.PageScraper does"""
+    bodystrings = []
+    for page in pages:
+        scraper = pagescraper.PageScraper('http://www.example.com', html.fromstring(page))
+        scraper.def_process_tree()
+        bodystrings.append(scraper.bodystring)
+    return bodystrings
+
+def bench_tokenize(n_pages=300):
+    """Times each stage of pagescraper.preprocess_bodystring, with the nltk and fast tokenizers, and checks that they agree on a golden corpus of synthetic pages
+    n_pages: number of synthetic pages. Default is 300"""
+    bodystrings = build_bodystrings(build_html_corpus(n_pages))
+    nltk = scorer.nltk_import()
+    scorer.load_vocab()
+
+    t_strip, texts = best_time(lambda: [pagescraper.strip_html_tags(x) for x in bodystrings])
+    t_punct, texts = best_time(lambda: [pagescraper.PUNCTUATION_REGEX.sub('', x) for x in texts])
+    t_nltk, tokens_nltk = best_time(lambda: [nltk['word_tokenize'](x.lower()) for x in texts])
+    t_fast, tokens_fast = best_time(lambda: [pagescraper.tokenize_fast(x) for x in bodystrings])
+    t_stem, processed = best_time(lambda: [scorer.stem_and_discard(x) for x in tokens_nltk])
+
+    differ = sum(a != b for a, b in zip(tokens_nltk, tokens_fast))
+    if differ:
+        raise Exception('The fast tokenizer disagrees with nltk on ' + str(differ) + ' postings')
+
+    print('tokenize: ' + str(n_pages) + ' postings, ' + str(sum(map(len, tokens_nltk))) + ' tokens')
+    print('  html parser:      %.3fs' % t_strip)
+    print('  punctuation:      %.3fs' % t_punct)
+    print('  word_tokenize:    %.3fs' % t_nltk)
+    print('  tokenize_fast:    %.3fs (x%.1f)' % (t_fast, (t_strip + t_punct + t_nltk)/t_fast))
+    print('  stem_and_discard: %.3fs' % t_stem)
+
+def time_subprocess(code, repeat=3):
+    """Times a fresh python interpreter running the code
+    code:   string of python code
+    repeat: number of runs. Default is 3
+
+    returns: best wall time in seconds"""
+    best = float('inf')
+    for k in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_import():
+    """Compares the cost of importing lib with the cost of loading the scoring resources"""
+    t_python = time_subprocess('pass')
+    t_import = time_subprocess('import lib')
+    t_snapshot = time_subprocess('import lib, scorer; scorer.load()')
+    t_cold = time_subprocess('import lib, scorer; scorer.load_vocab(use_snapshot=False); scorer.load_scorefile()')
+
+    print('import (python startup of %.3fs removed):' % t_python)
+    print('  import lib:                            %.3fs' % (t_import - t_python))
+    print('  import lib + load from vocab snapshot: %.3fs' % (t_snapshot - t_python))
+    print('  import lib + load from nltk corpora:   %.3fs' % (t_cold - t_python))
+
+def build_db_rows(n_rows, bodystring_len=3000, seed=0, start=None):
+    """Builds synthetic scraped job postings, as juntdb data dictionaries
+    n_rows:         number of rows to build
+    bodystring_len: number of characters of each bodystring. Default is 3000
+    seed:           random seed. Default is 0
+    start:          date ID of the first row, the others following by 1ms. If None, the current time is used. Default is None
+
+    returns: list of dicts"""
+    rng = random.Random(seed)
+    if start is None:
+        start = int(juntdb.build_timestamp_id())
+    body = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz   ') for _ in range(bodystring_len))
+    return [{'date':start + k, 'url':'http://www.example.com/job/' + str(k), 'loc':'Montreal',\
+             'bodystring':body, 'viewed':False, 'dead':False} for k in range(n_rows)]
+
+def bench_add_many(n_rows=10000, n_rows_add=500):
+    """Compares juntdb.add_many against one juntdb.add per row
+    n_rows:     number of rows inserted with add_many. Default is 10000
+    n_rows_add: number of rows inserted with add, which is much slower. Default is 500"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbase_file = os.path.join(tmpdir, 'bench.sqlite')
+        juntdb.init(dbase_file=dbase_file)
+        conn = juntdb.connect(dbase_file)
+
+        rows = build_db_rows(n_rows_add)
+        start = time.perf_counter()
+        for data in rows:
+            juntdb.add(data, conn=conn)
+        t_add = time.perf_counter() - start
+
+        rows = build_db_rows(n_rows, seed=1)
+        for data in rows:
+            data['date'] += n_rows_add
+        start = time.perf_counter()
+        juntdb.add_many(rows, conn=conn)
+        t_many = time.perf_counter() - start
+        conn.close()
+
+    print('insert:')
+    print('  add:      %d rows/s' % (n_rows_add/t_add))
+    print('  add_many: %d rows/s (%d rows in %.3fs)' % (n_rows/t_many, n_rows, t_many))
+
+def bench_timestamp_ids(n_threads=8, n_ids=500):
+    """Stress test of juntdb.build_timestamp_id from concurrent threads, compared with the wall clock milliseconds it replaced. Once its IDs are juntdb.ID_MAX_DRIFT_MS ahead of the clock, the allocator builds one ID per millisecond
+    n_threads: number of threads building IDs. Default is 8
+    n_ids:     number of IDs built by each thread. Default is 500"""
+    def wall_clock_id():
+        now = time.time()
+        return time.strftime('%Y%m%d%H%M%S', time.localtime(now)) + "%03d"%((now%1)*1000)
+
+    def run_threads(fct):
+        out = []
+        def target():
+            out.append([fct() for _ in range(n_ids)])
+        threads = [threading.Thread(target=target) for k in range(n_threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ids = [x for lst in out for x in lst]
+        return time.perf_counter() - start, len(ids) - len(set(ids))
+
+    t_wall, collisions_wall = run_threads(wall_clock_id)
+    t_alloc, collisions_alloc = run_threads(juntdb.build_timestamp_id)
+    drift = juntdb.LAST_ID_MS - int(time.time()*1000)
+    if collisions_alloc:
+        raise Exception('juntdb.build_timestamp_id built the same ID twice')
+
+    n = n_threads*n_ids
+    print('timestamp IDs: %d threads x %d IDs' % (n_threads, n_ids))
+    print('  wall clock:      %d IDs/s, %d collisions' % (n/t_wall, collisions_wall))
+    print('  ID allocator:    %d IDs/s, %d collisions, %dms ahead of the clock' % (n/t_alloc, collisions_alloc, max(drift, 0)))
+
+def bench_writer(n_spiders=8, n_batches=100, batch_size=50, n_runs=5):
+    """Stress test of concurrent writers. Simulated spiders insert row batches, either each with its own connection, or through a single juntdb.Writer. The medians of n_runs runs are reported, the shortest runs being noisy
+    n_spiders:  number of simulated spider threads. Default is 8
+    n_batches:  number of batches inserted by each spider. Default is 100
+    batch_size: number of rows per batch. Default is 50
+    n_runs:     number of runs of each mode, each into a new db. Default is 5"""
+    n_rows = n_spiders*n_batches*batch_size
+    def spider_batches(spider_index, start):
+        rows = build_db_rows(n_batches*batch_size, bodystring_len=500, seed=spider_index,\
+                             start=start + spider_index*n_batches*batch_size)
+        for data in rows:
+            data['url'] += '/' + str(spider_index)
+        return [rows[k:k+batch_size] for k in range(0, len(rows), batch_size)]
+
+    def run_spiders(target, batches):
+        threads = [threading.Thread(target=target, args=(batches[k],)) for k in range(n_spiders)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - start
+
+    t_direct = []
+    t_writer = []
+    commits = []
+    for k in range(n_runs):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbase_file = os.path.join(tmpdir, 'bench.sqlite')
+            juntdb.init(dbase_file=dbase_file)
+            start = int(juntdb.build_timestamp_id())
+
+            # Every spider commits its own batches, fighting over the db lock
+            def direct_spider(batches):
+                conn = juntdb.connect(dbase_file)
+                for rows in batches:
+                    juntdb.add_many(rows, conn=conn)
+                conn.close()
+            t_direct.append(run_spiders(direct_spider, [spider_batches(x, start) for x in range(n_spiders)]))
+
+            # Every spider hands its batches to the single writer thread
+            writer = juntdb.Writer(dbase_file)
+            writer.start()
+            def writer_spider(batches):
+                futures = [writer.add_many(rows) for rows in batches]
+                for future in futures:
+                    future.result()
+            t_writer.append(run_spiders(writer_spider, [spider_batches(x, start + n_rows) for x in range(n_spiders)]))
+            writer.close()
+            commits.append(writer.commits)
+
+    print('concurrent writes: %d spiders x %d batches x %d rows, median of %d runs' % (n_spiders, n_batches, batch_size, n_runs))
+    print('  one connection per spider: %d rows/s, %d commits' % (n_rows/statistics.median(t_direct), n_spiders*n_batches))
+    print('  single writer thread:      %d rows/s, %d commits' % (n_rows/statistics.median(t_writer), statistics.median(commits)))
+
+
+#---------------------------
+# End to end suite. Every stage group runs in a fresh interpreter, such that its peak RSS is its own. The corpus and the dbs are seeded, and their dates fixed, such that results are comparable across commits
+SUITE_SIZES = [1000, 100000, 1000000]
+SUITE_START_DATE = 20200101000000000
+SUITE_BATCH_SIZE = 10000
+
+# (url format, page format) of the synthetic postings of each website. The formats take the posting number, and the title, company and body strings
+SITE_PAGES = {
+    'indeed': ('http://www.indeed.ca/viewjob?jk={k:016x}',
+               '<html><head><title>{title} - Indeed.ca</title></head><body><div id="g_nav">Find Jobs Company Reviews Find Salaries</div>'
+               '<table><tr><td><b class="jobtitle"><font>{title}</font></b><span class="company">{company}</span>'
+               '<span id="job_summary" class="summary">{body}</span></td></tr></table><div id="footer">Cookies, Privacy and Terms</div></body></html>'),
+    'careerjet': ('http://www.careerjet.ca/jobad/ca{k:032x}',
+                  '<html><head><title>{title}</title></head><body><header><nav>Jobs Companies Salaries</nav></header>'
+                  '<main><h1>{title}</h1><p class="company">{company}</p><section class="content">{body}</section></main>'
+                  '<footer>Careerjet - Job search engine</footer></body></html>'),
+    'smartrecruiters': ('https://www.smartrecruiters.com/{company}/{k}-job',
+                        '<html><head><title>{title}</title></head><body><h1 class="job-title">{title}</h1>'
+                        '<div class="job-sections"><section><h2>Job Description</h2>{body}</section></div>'
+                        '<div class="footer">Powered by SmartRecruiters</div></body></html>'),
+    'generic': ('http://jobs.example.com/posting/{k}',
+                '<html><head><title>{title}</title></head><body><div class="posting"><h2>{title}</h2>{body}</div></body></html>'),
+}
+
+def build_site_corpus(n_pages, n_paragraphs=8, seed=0):
+    """Builds synthetic job posting pages of the websites of module.SITE_PAGES, in turn
+    n_pages:      number of pages to build
+    n_paragraphs: number of paragraphs per page. Default is 8
+    seed:         random seed. Default is 0
+
+    returns: list of (website, url, html bytes)"""
+    rng = random.Random(seed)
+    sites = sorted(SITE_PAGES)
+    corpus = []
+    for k in range(n_pages):
+        site = sites[k % len(sites)]
+        url_fmt, page_fmt = SITE_PAGES[site]
+        fields = {'k':k, 'title':'Data analyst ' + str(k), 'company':'company' + str(rng.randrange(100)),\
+                  'body':''.join(build_paragraphs(rng, n_paragraphs))}
+        corpus.append((site, url_fmt.format(**fields), page_fmt.format(**fields).encode('utf-8')))
+    return corpus
+
+def time_each(fct, items):
+    """Calls the function on each item
+    fct:   function of one argument
+    items: iterable of inputs
+
+    returns: (list of the latencies in seconds, list of the outputs)"""
+    latencies = []
+    outputs = []
+    for item in items:
+        start = time.perf_counter()
+        outputs.append(fct(item))
+        latencies.append(time.perf_counter() - start)
+    return latencies, outputs
+
+def stage_stats(latencies, n_items=None):
+    """Summarizes the latencies of the calls of a stage
+    latencies: list of the duration of each call, in seconds
+    n_items:   number of items processed by all the calls. If None, one per call. Default is None
+
+    returns: dict of the calls, items, total seconds, items per second, and p50/p99 call latencies in milliseconds"""
+    if n_items is None:
+        n_items = len(latencies)
+    total = sum(latencies)
+    return {'calls':len(latencies), 'items':n_items, 'seconds':total, 'items_per_sec':n_items/total if total else None,\
+            'p50_ms':float(np.percentile(latencies, 50))*1000, 'p99_ms':float(np.percentile(latencies, 99))*1000}
+
+def suite_postings(n_pages, seed=0):
+    """Times the stages of a posting, from its html page to the db
+    n_pages: number of synthetic pages
+    seed:    random seed. Default is 0
+
+    returns: dict of stage name -> stage_stats"""
+    scorer.load()
+    corpus = build_site_corpus(n_pages, seed=seed)
+    stages = {}
+
+    t_scrape, jentries = time_each(lambda page: pagescraper.jentry_from_page(page[1], page[2]), corpus)
+    t_preprocess, processed = time_each(lambda jentry: pagescraper.preprocess_bodystring(jentry.bodystring, fast=False), jentries)
+    t_fast, _ = time_each(lambda jentry: pagescraper.preprocess_bodystring(jentry.bodystring, fast=True), jentries)
+    t_score, scores = time_each(scorer.score, processed)
+    for jentry, processed_tokens, (score, score_hits) in zip(jentries, processed, scores):
+        jentry.processed_tokens = processed_tokens
+        jentry.score, jentry.score_hits = score, score_hits
+        jentry.scorefile_version = scorer.SCOREFILE_VERSION
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbase_file = os.path.join(tmpdir, 'bench.sqlite')
+        juntdb.init(dbase_file=dbase_file)
+        conn = juntdb.connect(dbase_file)
+        t_write, _ = time_each(lambda jentry: jentry.write_db(conn), jentries)
+        conn.close()
+
+    stages['PageScraper.scrape'] = stage_stats(t_scrape)
+    stages['preprocess_bodystring'] = stage_stats(t_preprocess)
+    stages['preprocess_bodystring_fast'] = stage_stats(t_fast)
+    stages['scorer.score'] = stage_stats(t_score)
+    stages['Jentry.write_db'] = stage_stats(t_write)
+    stages['end_to_end'] = stage_stats([sum(x) for x in zip(t_scrape, t_preprocess, t_score, t_write)])
+    return stages
+
+def suite_db(n_rows, seed=0, repeat=5):
+    """Times filling a synthetic db, then querying its high scoring entries
+    n_rows: number of rows of the db
+    seed:   random seed. Default is 0
+    repeat: number of queries. Default is 5
+
+    returns: dict of stage name -> stage_stats"""
+    rng = random.Random(seed)
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbase_file = os.path.join(tmpdir, 'bench.sqlite')
+        juntdb.init(dbase_file=dbase_file)
+        conn = juntdb.connect(dbase_file)
+
+        t_add = []
+        for start in range(0, n_rows, SUITE_BATCH_SIZE):
+            rows = build_db_rows(min(SUITE_BATCH_SIZE, n_rows - start), bodystring_len=500, seed=seed,\
+                                 start=SUITE_START_DATE + start)
+            for data in rows:
+                data['score'] = rng.gauss(0, 10)
+            t_start = time.perf_counter()
+            juntdb.add_many(rows, conn=conn)
+            t_add.append(time.perf_counter() - t_start)
+        stages['juntdb.add_many'] = stage_stats(t_add, n_rows)
+
+        # About 1% of the rows
+        t_fetch, fetched = time_each(lambda k: lib.fetch_scored_jentries(23, conn=conn), range(repeat))
+        stages['lib.fetch_scored_jentries'] = stage_stats(t_fetch, sum(map(len, fetched)))
+        conn.close()
+    return stages
+
+def measure(fct, args):
+    """Runs the function, then reads the peak RSS of the process. Module level such that it can be sent to a fresh interpreter
+
+    returns: (output of fct, peak RSS in kB)"""
+    out = fct(*args)
+    return out, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_isolated(fct, *args):
+    """Runs the function in a fresh interpreter
+
+    returns: dict with the 'stages' output by fct and the 'peak_rss_kb' of the interpreter"""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        stages, peak_rss = pool.apply(measure, (fct, args))
+    return {'peak_rss_kb':peak_rss, 'stages':stages}
+
+def git_commit():
+    """Returns the commit of the working tree, or None outside of git"""
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(n_pages=500, sizes=SUITE_SIZES, seed=0, output=None):
+    """Runs the end to end suite
+    n_pages: number of synthetic pages of the posting stages. Default is 500
+    sizes:   list of the number of rows of the synthetic dbs. Default is module.SUITE_SIZES
+    seed:    random seed. Default is 0
+    output:  string of the JSON file to write. If None, the JSON is printed. Default is None
+
+    returns: dict of the results"""
+    results = {'meta':{'commit':git_commit(), 'date':time.strftime('%Y-%m-%dT%H:%M:%S'), 'python':platform.python_version(),\
+                       'platform':platform.platform(), 'n_pages':n_pages, 'sizes':list(sizes), 'seed':seed}}
+    results['postings'] = run_isolated(suite_postings, n_pages, seed)
+    for n_rows in sizes:
+        results['db_' + str(n_rows)] = run_isolated(suite_db, n_rows, seed)
+
+    string = json.dumps(results, indent=2)
+    if output is None:
+        print(string)
+    else:
+        with open(output, 'w') as f:
+            f.write(string + '\n')
+    return results
+
+
+
+#---------------------------
+# Crawl throughput against mockboard, a local server with the markup of the job boards. Every concurrency setting crawls in a fresh interpreter, since the twisted reactor cannot be restarted
+CRAWL_CONCURRENCY = [1, 4, 16]
+
+def crawl_mock(base_url, n_searches, per_page, concurrency, dbase_dir, settings=None):
+    """Crawls the mock board with Indeed and Careerjet spiders into a new db in dbase_dir. Module level such that it can be sent to a fresh interpreter
+    base_url:    string of the url of the mock board
+    n_searches:  number of searches of each spider class
+    per_page:    number of postings per result page
+    concurrency: value of CONCURRENT_REQUESTS and CONCURRENT_REQUESTS_PER_DOMAIN
+    dbase_dir:   string of the directory of the db, which becomes the working directory
+    settings:    dict of extra scrapy settings. Default is None
+
+    returns: (start, end) wall clock times of the crawl. Raises an exception if no posting was written"""
+    # The spiders use the default db file, relative to the working directory
+    os.chdir(dbase_dir)
+    juntdb.init()
+    import webscraper
+    # The per domain cap of the spider classes would override the concurrency setting
+    custom_settings = dict(webscraper.SpiderIndeedCa.custom_settings, THROTTLE_DOMAIN_CONCURRENCY=concurrency)
+    def mock_spider(name, base):
+        return type(name, (base,), {'main_url_prefix':base_url, 'custom_settings':custom_settings})
+    indeed = mock_spider('MockIndeed', webscraper.SpiderIndeedCa)
+    careerjet = mock_spider('MockCareerjet', webscraper.SpiderCareerjetCa)
+    input_list = []
+    for k in range(n_searches):
+        input_list.append((indeed, ['search' + str(k)], {'views_per_page':per_page}))
+        input_list.append((careerjet, ['search' + str(k)], {}))
+
+    start = time.time()
+    webscraper.crawl_many(input_list, dict({'CONCURRENT_REQUESTS':concurrency, 'CONCURRENT_REQUESTS_PER_DOMAIN':concurrency,\
+                                            'LOG_LEVEL':'WARNING'}, **(settings or {})))
+    end = time.time()
+    # scrapy logs the errors of the crawl instead of raising them
+    if not count_postings(juntdb.DEF_DB):
+        raise Exception('The crawl of the mock board wrote no posting, see the scrapy log')
+    return start, end
+
+def count_postings(dbase_file):
+    """Returns the number of rows of the db, or 0 if it is not created yet"""
+    try:
+        conn = juntdb.connect(dbase_file)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM ' + juntdb.DEF_TABLE).fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.OperationalError:
+        return 0
+
+def bench_crawl(concurrency=CRAWL_CONCURRENCY, n_searches=2, result_pages=5, per_page=20, latency=0.02, error_rate=0.0,\
+                settings=None, output=None):
+    """Throughput of webscraper.crawl_many against a local mockboard.MockBoard, for several concurrency settings
+    concurrency:  list of the values of CONCURRENT_REQUESTS. Default is module.CRAWL_CONCURRENCY
+    n_searches:   number of searches of each spider class. Default is 2
+    result_pages: number of result pages of each search. Default is 5
+    per_page:     number of postings per result page. Default is 20
+    latency:      delay in seconds of each response of the server. Default is 0.02
+    error_rate:   probability that the server answers 503. Default is 0.0
+    settings:     dict of extra scrapy settings. Default is None
+    output:       string of the JSON file to write. If None, the JSON is printed. Default is None
+
+    returns: dict of the results"""
+    board = mockboard.MockBoard(0, result_pages, per_page, latency, error_rate)
+    board.start()
+    results = {'meta':{'commit':git_commit(), 'date':time.strftime('%Y-%m-%dT%H:%M:%S'), 'python':platform.python_version(),\
+                       'n_searches':n_searches, 'result_pages':result_pages, 'per_page':per_page, 'latency':latency,\
+                       'error_rate':error_rate}}
+    try:
+        for value in concurrency:
+            board.reset_counts()
+            with tempfile.TemporaryDirectory() as tmpdir, multiprocessing.get_context('spawn').Pool(1) as pool:
+                dbase_file = os.path.join(tmpdir, juntdb.DEF_DB)
+                job = pool.apply_async(crawl_mock, (board.base_url, n_searches, per_page, value, tmpdir, settings))
+                # The first write is seen by polling the db from this process
+                first_write = None
+                while not job.ready():
+                    if first_write is None and count_postings(dbase_file):
+                        first_write = time.time()
+                    time.sleep(0.01)
+                start, end = job.get()
+                n_postings = count_postings(dbase_file)
+
+            counts = dict(board.counts)
+            elapsed = end - start
+            n_pages = counts['result_pages'] + counts['posting_pages']
+            if not n_pages:
+                raise Exception('The mock board served no page at concurrency ' + str(value))
+            results['concurrency_' + str(value)] = {
+                'seconds':elapsed, 'pages':n_pages, 'postings':n_postings, 'server':counts,
+                'pages_per_sec':n_pages/elapsed, 'postings_per_sec':n_postings/elapsed,
+                'time_to_first_write':None if first_write is None else first_write - start}
+    finally:
+        board.stop()
+
+    string = json.dumps(results, indent=2)
+    if output is None:
+        print(string)
+    else:
+        with open(output, 'w') as f:
+            f.write(string + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the junthelper routines')
+    parser.add_argument('--suite', action='store_true', help='run the end to end suite instead, and output its JSON results')
+    parser.add_argument('--crawl', action='store_true', help='run the crawl throughput benchmark against the mock board instead, and output its JSON results')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=CRAWL_CONCURRENCY, help='CONCURRENT_REQUESTS values of the crawl benchmark')
+    parser.add_argument('--latency', type=float, default=0.02, help='delay in seconds of each response of the mock board')
+    parser.add_argument('--pages', type=int, default=500, help='number of synthetic pages of the suite')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SUITE_SIZES, help='number of rows of the synthetic dbs of the suite')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the suite')
+    parser.add_argument('--output', default=None, help='JSON file of the suite or crawl results. Printed if omitted')
+    args = parser.parse_args()
+
+    if args.suite:
+        run_suite(args.pages, args.sizes, args.seed, args.output)
+    elif args.crawl:
+        bench_crawl(args.concurrency, latency=args.latency, output=args.output)
+    else:
+        bench_score()
+        bench_matrix()
+        bench_tokenize()
+        bench_import()
+        bench_add_many()
+        bench_timestamp_ids()
+        bench_writer()
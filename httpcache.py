@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Pooled HTTP session and on-disk cache of the scraped job postings, revalidated with conditional GET requests"""
+
+import sqlite3
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Default values
+DEF_CACHE_DB = 'httpcache.sqlite'
+DEF_MAX_BYTES = 200*1024*1024
+POOL_CONNECTIONS = 20 # Number of hosts with kept-alive connections
+POOL_MAXSIZE = 10     # Number of kept-alive connections per host
+
+SESSION = None
+CACHE = None
+
+
+def get_session():
+    """Returns the module-wide requests session. Connections are kept alive and pooled per host"""
+    global SESSION
+    if SESSION is None:
+        SESSION = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        SESSION.mount('http://', adapter)
+        SESSION.mount('https://', adapter)
+    return SESSION
+
+def get_cache():
+    """Returns the module-wide ResponseCache, opened on first use"""
+    global CACHE
+    if CACHE is None:
+        CACHE = ResponseCache()
+    return CACHE
+
+class ResponseCache:
+    """Cache of the extracted bodystring of job postings, keyed by their url after redirections. Entries store the ETag and Last-Modified validators of the response"""
+    def __init__(self, dbase_file=DEF_CACHE_DB, max_bytes=DEF_MAX_BYTES):
+        """Opens or creates the cache
+        dbase_file: string of the sqlite file of the cache. Default is module.DEF_CACHE_DB
+        max_bytes:  size cap of the cached bodystrings. The least recently used entries are evicted past it. Default is module.DEF_MAX_BYTES"""
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = sqlite3.connect(dbase_file, timeout=30.0)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses (final_url TEXT PRIMARY KEY, etag TEXT, '
+                              'last_modified TEXT, bodystring TEXT, size INTEGER, last_used REAL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS aliases (url TEXT PRIMARY KEY, final_url TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used_idx ON responses (last_used)')
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def lookup(self, url):
+        """Finds the cached entry of the url, following the redirections seen previously
+        url: string of the requested url
+
+        returns: (final url, etag, last modified, bodystring), or None if the url is not cached"""
+        alias = self.conn.execute('SELECT final_url FROM aliases WHERE url=?', (url,)).fetchone()
+        final_url = alias[0] if alias else url
+        string = 'SELECT final_url, etag, last_modified, bodystring FROM responses WHERE final_url=?'
+        return self.conn.execute(string, (final_url,)).fetchone()
+
+    def validators(self, entry):
+        """Returns the conditional request headers of a cached entry"""
+        _, etag, last_modified, _ = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def hit(self, entry):
+        """Records that the server answered 304 Not Modified for the cached entry"""
+        self.hits += 1
+        with self.conn:
+            self.conn.execute('UPDATE responses SET last_used=? WHERE final_url=?', (time.time(), entry[0]))
+
+    def store(self, url, response, bodystring):
+        """Caches the bodystring extracted from a response. Responses without validators are only counted
+        url:        string of the requested url
+        response:   requests response, after redirections
+        bodystring: string extracted from the response"""
+        self.misses += 1
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not (etag or last_modified) or response.status_code != 200:
+            return
+
+        size = len(bodystring)
+        previous = self.conn.execute('SELECT size FROM responses WHERE final_url=?', (response.url,)).fetchone()
+        self.total_bytes += size - (previous[0] if previous else 0)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?)',\
+                              (response.url, etag, last_modified, bodystring, size, time.time()))
+            if url != response.url:
+                self.conn.execute('INSERT OR REPLACE INTO aliases VALUES (?,?)', (url, response.url))
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is under its size cap"""
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        evicted = []
+        for final_url, size in self.conn.execute('SELECT final_url, size FROM responses ORDER BY last_used'):
+            if self.total_bytes <= self.max_bytes:
+                break
+            evicted.append((final_url,))
+            self.total_bytes -= size
+        with self.conn:
+            self.conn.executemany('DELETE FROM responses WHERE final_url=?', evicted)
+            self.conn.executemany('DELETE FROM aliases WHERE final_url=?', evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        """Returns a dict of the entry count, cached bytes, hits, misses, evictions and hit rate"""
+        count = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        requests_count = self.hits + self.misses
+        hit_rate = self.hits / requests_count if requests_count else 0.0
+        return {'entries':count, 'bytes':self.total_bytes, 'hits':self.hits, 'misses':self.misses,\
+                'evictions':self.evictions, 'hit_rate':hit_rate}
+
+    def close(self):
+        self.conn.close()
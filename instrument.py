@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Timing and counting of the stages of a crawl or scoring run: fetching, page parsing, tokenizing, scoring and db writes. Disabled by default, in which case a timed function only costs one flag check"""
+
+import json
+import time
+import bisect
+import logging
+import functools
+import threading
+import contextlib
+
+
+# Set by enable(). Checked on every call of a timed function
+ENABLED = False
+
+# Upper edges in seconds of the latency histogram buckets, doubling from 1 microsecond to about 2 minutes. The last bucket is unbounded
+BUCKET_EDGES = [1e-6*2**k for k in range(28)]
+
+# Files written by dump at the end of lib.exec_crawl and lib.score_db
+CRAWL_DUMP_FILE = 'instrument_crawl.json'
+SCORE_DUMP_FILE = 'instrument_score.json'
+
+# Prefix of the keys set in the scrapy stats collector
+STATS_PREFIX = 'junthelper/'
+
+STAGES = {}
+LOCK = threading.Lock()
+# Stages of the current scope of each thread, e.g. those of one crawler, recorded besides module.STAGES. See scope
+SCOPES = threading.local()
+
+
+class Stage:
+    """Count, total time and latency histogram of one stage"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0]*(len(BUCKET_EDGES) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKET_EDGES, seconds)] += 1
+
+    def merge(self, other):
+        """Adds the occurences of another stage, e.g. recorded in another process"""
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def percentile(self, q):
+        """Upper edge of the bucket holding the q quantile, capped by the largest recorded latency"""
+        rank = q*self.count
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(BUCKET_EDGES[k], self.max) if k < len(BUCKET_EDGES) else self.max
+        return 0.0
+
+    def summary(self):
+        """Returns a dict of the count, total, mean, p50, p99 and max latencies in seconds, and the non-empty histogram buckets keyed by their upper edge"""
+        histogram = {('%.6g' % BUCKET_EDGES[k] if k < len(BUCKET_EDGES) else 'inf'):n for k, n in enumerate(self.buckets) if n}
+        return {'count':self.count, 'total':self.total, 'mean':self.total/self.count if self.count else 0.0,\
+                'p50':self.percentile(0.5), 'p99':self.percentile(0.99), 'max':self.max, 'histogram':histogram}
+
+def enable(flag=True):
+    """Turns the instrumentation on or off. The recorded stages are kept"""
+    global ENABLED
+    ENABLED = flag
+
+def reset():
+    """Forgets all the recorded stages"""
+    with LOCK:
+        STAGES.clear()
+
+def record(name, seconds, stages=None):
+    """Adds one occurence of the stage
+    name:    string of the stage
+    seconds: duration of the occurence. None only increments the count
+    stages:  dict of the stages to add it to. Default is module.STAGES, and the stages of the current scope, see scope"""
+    if stages is None:
+        targets = [STAGES, current_scope()]
+    else:
+        targets = [stages]
+    with LOCK:
+        for stages in targets:
+            if stages is None:
+                continue
+            stage = stages.get(name)
+            if stage is None:
+                stage = stages[name] = Stage()
+            if seconds is None:
+                stage.count += 1
+            else:
+                stage.add(seconds)
+
+@contextlib.contextmanager
+def scope(stages):
+    """Context manager also recording the stages of the current thread in the input dict, e.g. to keep those of one crawler apart
+    stages: dict of the stages. None records nothing more"""
+    if stages is None or not ENABLED:
+        yield
+        return
+    outer = current_scope()
+    SCOPES.stages = stages
+    try:
+        yield
+    finally:
+        SCOPES.stages = outer
+
+def current_scope():
+    """Returns the stages dict of the innermost scope of the current thread, or None"""
+    return getattr(SCOPES, 'stages', None)
+
+def start():
+    """Returns the start time of a span ended by stop, or None if disabled"""
+    return time.perf_counter() if ENABLED else None
+
+def stop(name, started, stages=None):
+    """Records the span begun at started, the output of start. Nothing is recorded if it is None
+    stages: dict of the stages to add it to. Default is that of record"""
+    if started is not None:
+        record(name, time.perf_counter() - started, stages)
+
+def timed(name):
+    """Decorator recording the duration of every call of the function as the stage name"""
+    def decorator(fct):
+        @functools.wraps(fct)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fct(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fct(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+def snapshot(stages=None):
+    """Returns a dict of the summary of every stage, see Stage.summary
+    stages: dict of the stages. Default is module.STAGES"""
+    if stages is None:
+        stages = STAGES
+    with LOCK:
+        return {name:stage.summary() for name, stage in sorted(stages.items())}
+
+def drain():
+    """Returns the recorded stages and forgets them. Used in the worker processes, whose stages are sent to the parent for merge"""
+    global STAGES
+    with LOCK:
+        stages, STAGES = STAGES, {}
+    return stages
+
+def merge(stages):
+    """Adds stages recorded elsewhere, e.g. the output of drain in a worker process
+    stages: dict of name -> Stage"""
+    with LOCK:
+        for name, other in stages.items():
+            stage = STAGES.get(name)
+            if stage is None:
+                stage = STAGES[name] = Stage()
+            stage.merge(other)
+
+def to_stats(stats, stages=None):
+    """Sets the count, total, p50, p99 and max of every stage in a scrapy stats collector
+    stats:  scrapy StatsCollector
+    stages: dict of the stages. Default is module.STAGES"""
+    for name, summary in snapshot(stages).items():
+        for key in ['count', 'total', 'p50', 'p99', 'max']:
+            stats.set_value(STATS_PREFIX + name + '/' + key, summary[key])
+
+def dump(filename):
+    """Writes the snapshot as JSON, if the instrumentation is enabled
+    filename: string of the JSON file"""
+    if not ENABLED:
+        return
+    with open(filename, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+        f.write('\n')
+    logging.info('Instrumentation written to ' + filename)
@@ -5,8 +5,16 @@ import numpy as np
 import time
 import sqlite3
 import io
+import os
 import inspect
 import types
+import atexit
+import threading
+import contextlib
+import queue
+import concurrent.futures
+
+import instrument
 
 
 # Default values
@@ -15,19 +23,58 @@ DEF_DB = 'juntdb.sqlite'
 DEF_ASSOC_TABLE = 'type_assoc'
 DEF_COL_NAMES = ['url',  'loc',  'bodystring', 'tokens', 'score', 'viewed', 'dead']
 DEF_COL_TYPES = ['TEXT', 'TEXT', 'TEXT',       'TEXT',   'REAL',  'BOOL',  'BOOL']
+FTS_COL = 'processed_tokens' # Column indexed by init_fts
+WATERMARKS_TABLE = 'crawl_watermarks' # Newest postings of the last crawl of each search, see get_watermark
 
 __PRIMARY = 'date'
 __PRIMARY_TYPE = 'INTEGER'
 
+# Applied to every connection. WAL lets readers run alongside a writer
+PRAGMAS = [
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'cache_size=-65536',   # KiB, i.e. 64 MB
+    'mmap_size=268435456', # 256 MB
+    'temp_store=MEMORY',
+]
+
+# Per-thread pooled connections, see get_conn
+POOL = threading.local()
+POOL_LOCK = threading.Lock()
+POOL_ALL = [] # every pooled connection, closed at exit
+TYPES_REGISTERED = False
+
+# IDs are the local time to the millisecond. IDs built within the same millisecond borrow the next free ones, up to ID_MAX_DRIFT_MS ahead of the clock, see build_timestamp_id
+TIMESTAMP_ID_LEN = 17 # YYYYmmddHHMMSS + milliseconds
+ID_MAX_DRIFT_MS = 1000
+ID_LOCK = threading.Lock()
+LAST_ID_MS = 0 # Epoch milliseconds of the last ID built by this process
+
 
 #---------------------------
 def build_timestamp_id():
-    """Builds a timestamp from the local clock"""
-    now = time.time()
-    localtime = time.localtime(now)
+    """Builds a timestamp from the local clock. The IDs built by a process are unique and increasing, even from several threads: when the clock did not advance since the last ID, the next millisecond is used. Once the IDs are module.ID_MAX_DRIFT_MS ahead of the clock, it waits for the clock to catch up"""
+    global LAST_ID_MS
+    with ID_LOCK:
+        now = int(time.time()*1000)
+        ms = max(now, LAST_ID_MS + 1)
+        if ms - now > ID_MAX_DRIFT_MS:
+            time.sleep((ms - now - ID_MAX_DRIFT_MS)/1000)
+        LAST_ID_MS = ms
+    localtime = time.localtime(ms // 1000)
     tstr = time.strftime('%Y%m%d%H%M%S', localtime)
-    msstr = "%03d"%((now%1)*1000)
+    msstr = "%03d"%(ms % 1000)
     return tstr + msstr
+def reserve_timestamp_ids(date):
+    """Makes sure the IDs built afterwards by build_timestamp_id are greater than the input ID, e.g. the last one of the db
+    date: timestamp ID, as built by build_timestamp_id"""
+    global LAST_ID_MS
+    datestr = str(date)
+    if len(datestr) != TIMESTAMP_ID_LEN:
+        return
+    ms = int(time.mktime(time.strptime(datestr[:14], '%Y%m%d%H%M%S')))*1000 + int(datestr[14:])
+    with ID_LOCK:
+        LAST_ID_MS = max(LAST_ID_MS, ms)
 def pprint_date(date):
     """Pretty prints the dateid"""
     datestr = str(date)
@@ -84,7 +131,37 @@ def convert_float64(number):
 def convert_function(text):
     return text.decode("utf-8")
 
-def connect(dbase_file=DEF_DB):
+class Connection(sqlite3.Connection):
+    """sqlite connection that caches the table schemas and the type associations"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.schema_cache = {}  # table name -> list of column names
+        self.type_assoc = None
+
+def get_schema(conn, tn=DEF_TABLE, refresh=False):
+    """Returns the column names of the table, cached per connection when possible
+    conn:    sqlite connection object
+    tn:      table name. Default is module.DEF_TABLE
+    refresh: if true, reads the schema from the db even if it is cached"""
+    cache = getattr(conn, 'schema_cache', {})
+    if refresh or tn not in cache:
+        cache[tn] = get_cols(tn=tn, conn=conn)
+    return cache[tn]
+
+def get_cached_type_assoc(conn):
+    """Returns the type associations, cached per connection when possible"""
+    type_assoc = getattr(conn, 'type_assoc', None)
+    if type_assoc is None:
+        type_assoc = get_type_assoc(conn)
+        if isinstance(conn, Connection):
+            conn.type_assoc = type_assoc
+    return type_assoc
+
+def register_types():
+    """Registers the sqlite adapters and converters of the juntdb types. Only the first call does anything"""
+    global TYPES_REGISTERED
+    if TYPES_REGISTERED:
+        return
     sqlite3.register_adapter(np.ndarray, adapt_array)
     sqlite3.register_adapter(list, adapt_list)
     sqlite3.register_adapter(dict, adapt_dict)
@@ -98,15 +175,54 @@ def connect(dbase_file=DEF_DB):
     sqlite3.register_converter("BOOL", convert_bool)
     sqlite3.register_converter("FLOAT64", convert_float64)
     sqlite3.register_converter("FUNCTION", convert_function)
+    TYPES_REGISTERED = True
 
-
-    conn = sqlite3.connect(dbase_file, detect_types=sqlite3.PARSE_DECLTYPES, timeout=30.0)
+def connect(dbase_file=DEF_DB):
+    """Opens a new connection with the module.PRAGMAS applied. The caller is responsible for closing it; prefer get_conn"""
+    register_types()
+    conn = sqlite3.connect(dbase_file, detect_types=sqlite3.PARSE_DECLTYPES, timeout=30.0, factory=Connection)
+    for pragma in PRAGMAS:
+        conn.execute('PRAGMA ' + pragma)
     return conn
+def get_conn(dbase_file=DEF_DB):
+    """Returns the pooled connection of the current thread to the db file, opening it on first use. It is reused by every juntdb call and must not be closed by the caller"""
+    # A forked process must not share the sqlite connection of its parent
+    pid = os.getpid()
+    if getattr(POOL, 'pid', None) != pid:
+        POOL.pid = pid
+        POOL.conns = {}
+    conn = POOL.conns.get(dbase_file)
+    if conn is None:
+        conn = connect(dbase_file)
+        POOL.conns[dbase_file] = conn
+        with POOL_LOCK:
+            POOL_ALL.append((pid, conn))
+    return conn
+@contextlib.contextmanager
+def connection(dbase_file=DEF_DB, conn=False):
+    """Context manager yielding conn, or the pooled connection of the current thread if conn is False. Commits on success and rolls back on error; the connection stays open
+    conn: sqlite connection object to use. Default is False"""
+    if conn == False:
+        conn = get_conn(dbase_file)
+    with conn:
+        yield conn
+def close_pool():
+    """Closes every pooled connection opened by this process"""
+    pid = os.getpid()
+    with POOL_LOCK:
+        for owner, conn in POOL_ALL:
+            if owner == pid:
+                try:
+                    conn.close()
+                except sqlite3.ProgrammingError:
+                    pass # Connection of another, already finished, thread
+        POOL_ALL[:] = [x for x in POOL_ALL if x[0] != pid]
+    if getattr(POOL, 'pid', None) == pid:
+        POOL.conns = {}
+atexit.register(close_pool)
 def clear_table(tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
-    close_conn = False
     if conn == False: 
-        conn = connect(dbase_file)
-        closeconn = True
+        conn = get_conn(dbase_file)
 
     field_name = __PRIMARY
     field_type = __PRIMARY_TYPE
@@ -116,11 +232,10 @@ def clear_table(tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     c.execute('CREATE TABLE {tn} ({fn} {ft} PRIMARY KEY)'\
               .format(tn=tn, fn=field_name, ft=field_type))
     conn.commit()
+    getattr(conn, 'schema_cache', {}).pop(tn, None)
 
-    if close_conn:
-        conn.close()
 def init(dbase_file=DEF_DB, table_name=DEF_TABLE):
-    conn = sqlite3.connect(dbase_file)
+    conn = connect(dbase_file)
     c = conn.cursor()
 
     field_name = __PRIMARY
@@ -157,12 +272,21 @@ def get_type_assoc(conn, tn_assoc=DEF_ASSOC_TABLE):
     c = conn.cursor()
     cursor = c.execute('select * from ' + tn_assoc)
     return dict(cursor.fetchall())
-def add_cols(col_names,col_types, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
-    """Adds columns to the database"""
-    close_conn = False
+def get_cols(tn=DEF_TABLE, conn=False, dbase_file=DEF_DB):
+    """Returns the list of column names of the table"""
     if conn == False: 
-        conn = connect(dbase_file)
-        closeconn = True
+        conn = get_conn(dbase_file)
+
+    c = conn.cursor()
+    cursor = c.execute('select * from ' + tn + ' limit 0')
+    cols = [x[0] for x in cursor.description]
+
+    return cols
+def add_cols(col_names,col_types, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False, commit=True):
+    """Adds columns to the database
+    commit: if false, the columns are added in the open transaction, for the caller to commit. Default is True"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
     
     if len(col_names) != len(col_types):
         raise Exception('Different length of columns names / types')
@@ -176,17 +300,16 @@ def add_cols(col_names,col_types, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     c = conn.cursor()
     for x, y in zip(col_names, col_types):
         c.execute("ALTER TABLE {tn} ADD COLUMN '{cn}' {ct}".format(tn=tn, cn=x, ct=y))
-    conn.commit()
+    if commit:
+        conn.commit()
+    getattr(conn, 'schema_cache', {}).pop(tn, None)
 
-    if close_conn:
-        conn.close()
 
+@instrument.timed('db_add')
 def add(data, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False, new_data=True):
     """Adds the data dictionary as one row. If new columns are added, older entries will be appropriately initiated"""
-    close_conn = False
     if conn == False: 
-        conn = connect(dbase_file)
-        closeconn = True
+        conn = get_conn(dbase_file)
 
     c = conn.cursor()
     cursor = c.execute('select * from ' + tn)
@@ -197,7 +320,7 @@ def add(data, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False, new_data=True):
     # Exceptions in input data dict
     if not __PRIMARY in datacols:
         raise AttributeError('The data dict is missing the ' + __PRIMARY + ' ID (Primary attribute)')
-    elif len(str(data[__PRIMARY])) != len(str(build_timestamp_id())):
+    elif len(str(data[__PRIMARY])) != TIMESTAMP_ID_LEN:
         raise ValueError("The date is of improper size. Did you use build_timestamp_id to make it?")
 
     # find and add nonexistant colums when necessary.
@@ -215,6 +338,8 @@ def add(data, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False, new_data=True):
     for x in toadd:
         c.execute("ALTER TABLE {tn} ADD COLUMN '{cn}' {ct}"\
                   .format(tn=tn, cn=x[0], ct=x[1]))
+    if toadd:
+        getattr(conn, 'schema_cache', {}).pop(tn, None)
     
 
     
@@ -260,7 +385,12 @@ def add(data, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False, new_data=True):
         try:
             thing_that_goes_wrong()
             done = True
-        except sqlite3.IntegrityError:
+        except sqlite3.IntegrityError as e:
+            # Only the primary key can be fixed this way. Other unique columns are the caller's problem
+            if not str(e).endswith(tn + '.' + __PRIMARY):
+                raise
+            # Another process took the ID. The new one is past every ID of the db, so this is retried once at most
+            reserve_timestamp_ids(c.execute("SELECT MAX(" + __PRIMARY + ") FROM " + tn).fetchone()[0])
             data[__PRIMARY] = build_timestamp_id() # This should propagate to parent namespace
 
 
@@ -275,14 +405,203 @@ def add(data, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False, new_data=True):
             raise Exception('Failed to commit changes to db')
 
 
-    if close_conn:
-        conn.close()
+@instrument.timed('db_add_many')
+def add_many(rows, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False, or_ignore=False, commit=True):
+    """Adds each data dictionary of rows as a new row, in a single transaction. Missing columns are added once for the whole batch
+    rows:      list of data dictionaries, as for add(). Colliding dates are replaced by new timestamp IDs in the input dicts
+    or_ignore: if true, rows violating a unique index are silently skipped. Default is False
+    commit:    if false, the transaction is left open for the caller to commit. Default is True
+
+    returns: number of rows inserted"""
+    if not rows:
+        return 0
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    for data in rows:
+        if not __PRIMARY in data:
+            raise AttributeError('The data dict is missing the ' + __PRIMARY + ' ID (Primary attribute)')
+        elif len(str(data[__PRIMARY])) != TIMESTAMP_ID_LEN:
+            raise ValueError("The date is of improper size. Did you use build_timestamp_id to make it?")
+
+    insert = "INSERT OR IGNORE INTO " if or_ignore else "INSERT INTO "
+    changes = conn.total_changes
+    try:
+        with (conn if commit else contextlib.nullcontext()):
+            # The write lock is taken before the schema and the taken IDs are checked, such that no other process changes them in between
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+
+            # Columns absent from the table are typed after the first row holding them. They are added in the transaction, hence rolled back with the rows
+            dbcols = get_schema(conn, tn)
+            newcols = {}
+            for data in rows:
+                for x in data:
+                    if x not in dbcols and x not in newcols:
+                        newcols[x] = type(data[x]).__name__
+            if newcols:
+                # The cached schema may predate another writer
+                dbcols = get_schema(conn, tn, refresh=True)
+                type_assoc = get_cached_type_assoc(conn)
+                toadd = []
+                for x, tmp in newcols.items():
+                    if x in dbcols:
+                        continue
+                    try:
+                        toadd.append([x, type_assoc[tmp]])
+                    except KeyError as e:
+                        raise KeyError("Incompatible type "+str(e)+", type: "+str(tmp)+" for data entry '"+str(x) +"'")
+                if toadd:
+                    add_cols(*zip(*toadd), tn=tn, conn=conn, commit=False)
+
+            # IDs from build_timestamp_id never collide within a process. Those taken by another process, or reused by the caller, get a new ID past every ID of the db
+            dates = [int(data[__PRIMARY]) for data in rows]
+            taken = set()
+            c = conn.cursor()
+            for k in range(0, len(dates), 500):
+                chunk = dates[k:k+500]
+                string = "SELECT date FROM " + tn + " WHERE date IN (" + ','.join('?'*len(chunk)) + ")"
+                taken.update(x[0] for x in c.execute(string, chunk))
+            if taken or len(set(dates)) != len(dates):
+                reserve_timestamp_ids(max(dates + [c.execute("SELECT MAX(date) FROM " + tn).fetchone()[0] or 0]))
+                seen = set()
+                for data, date in zip(rows, dates):
+                    if date in taken or date in seen:
+                        data[__PRIMARY] = build_timestamp_id() # This should propagate to parent namespace
+                        date = int(data[__PRIMARY])
+                    seen.add(date)
+
+            # Rows with the same columns share one INSERT statement
+            groups = {}
+            for data in rows:
+                collist = tuple(data.keys())
+                vallist = tuple(list(val.items()) if type(val) == type(dict()) else val for val in data.values())
+                groups.setdefault(collist, []).append(vallist)
+            for collist, vallists in groups.items():
+                string = insert + tn + " (" + ','.join(collist) + ") VALUES (" + ','.join('?'*len(collist)) + ")"
+                conn.executemany(string, vallists)
+    except Exception:
+        # Columns added by the rolled back transaction may be in the cached schema
+        getattr(conn, 'schema_cache', {}).pop(tn, None)
+        raise
+    inserted = conn.total_changes - changes
+
+    return inserted
+def update_many(rows, collist, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False, commit=True):
+    """Updates existing rows in a single transaction
+    rows:    iterable of (date, value of collist[0], value of collist[1], ...)
+    collist: list of the column names to update. They must already exist in the table
+    commit:  if false, the transaction is left open for the caller to commit. Default is True"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    setstring = ','.join([cn + '=?' for cn in collist])
+    string = "UPDATE " + tn + " SET " + setstring + " WHERE " + __PRIMARY + "=?"
+    with (conn if commit else contextlib.nullcontext()):
+        conn.executemany(string, (tuple(row[1:]) + (row[0],) for row in rows))
+
+def create_index(col, unique=False, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
+    """Creates an index on the column, if it does not exist yet
+    unique: if true, the index prevents two rows from sharing a value. NULL values are never considered equal. Default is False"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    string = "CREATE " + ("UNIQUE " if unique else "") + "INDEX IF NOT EXISTS " + \
+             index_name(col, tn) + " ON " + tn + " (" + col + ")"
+    with conn:
+        conn.execute(string)
+
+def index_name(col, tn=DEF_TABLE):
+    """Name of the index created by create_index"""
+    return tn + '_' + col + '_idx'
+def has_index(col, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
+    """Returns true if create_index was already run on the column"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    string = "SELECT name FROM sqlite_master WHERE type='index' AND name=?"
+    found = conn.execute(string, (index_name(col, tn),)).fetchone() is not None
+
+    return found
+def init_fts(col=FTS_COL, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
+    """Creates the FTS5 index of a text column, if it does not exist yet. Triggers keep it in sync with the inserts, updates and deletes of the table, and the existing rows are indexed
+    col: name of the indexed column, added to the table if missing. Default is module.FTS_COL"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    if has_fts(tn, conn=conn):
+        return
+    if col not in get_cols(tn, conn=conn):
+        add_cols([col], ['TEXT'], tn=tn, conn=conn)
+
+    # External content table: the text is only stored in tn, the index refers to its rows by date
+    fts = fts_name(tn)
+    fmt = {'fts':fts, 'tn':tn, 'col':col, 'pk':__PRIMARY}
+    strings = [
+        "CREATE VIRTUAL TABLE {fts} USING fts5({col}, content='{tn}', content_rowid='{pk}')",
+        "CREATE TRIGGER {fts}_ai AFTER INSERT ON {tn} BEGIN "
+            "INSERT INTO {fts} (rowid, {col}) VALUES (new.{pk}, new.{col}); END",
+        "CREATE TRIGGER {fts}_ad AFTER DELETE ON {tn} BEGIN "
+            "INSERT INTO {fts} ({fts}, rowid, {col}) VALUES ('delete', old.{pk}, old.{col}); END",
+        "CREATE TRIGGER {fts}_au AFTER UPDATE OF {col} ON {tn} BEGIN "
+            "INSERT INTO {fts} ({fts}, rowid, {col}) VALUES ('delete', old.{pk}, old.{col}); "
+            "INSERT INTO {fts} (rowid, {col}) VALUES (new.{pk}, new.{col}); END",
+        "INSERT INTO {fts} ({fts}) VALUES ('rebuild')",
+        ]
+    with conn:
+        for string in strings:
+            conn.execute(string.format(**fmt))
+
+def fts_name(tn=DEF_TABLE):
+    """Name of the FTS5 table created by init_fts"""
+    return tn + '_fts'
+def has_fts(tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
+    """Returns true if init_fts was already run on the table"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    string = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+    found = conn.execute(string, (fts_name(tn),)).fetchone() is not None
+
+    return found
+def init_watermarks(dbase_file=DEF_DB, conn=False):
+    """Creates the table of the crawl watermarks, if it does not exist yet"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS " + WATERMARKS_TABLE + " (spider TEXT, query TEXT, location TEXT, "
+                     "url_keys TEXT, date INTEGER, PRIMARY KEY (spider, query, location))")
+def get_watermark(spider, query, location, dbase_file=DEF_DB, conn=False):
+    """Fetches the watermark left by the last crawl of a search
+    spider:   string of the spider class name
+    query:    string of the searched words
+    location: string of the searched location
+
+    returns: (set of the url keys of the first result page, timestamp ID of the crawl), or None"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    string = "SELECT url_keys, date FROM " + WATERMARKS_TABLE + " WHERE spider=? AND query=? AND location=?"
+    row = conn.execute(string, (spider, query, location)).fetchone()
+    if row is None:
+        return None
+    return set(row[0].split('\n')) if row[0] else set(), row[1]
+def set_watermarks(rows, dbase_file=DEF_DB, conn=False, commit=True):
+    """Stores the watermarks of crawled searches, replacing the previous ones. Compatible with Writer.submit
+    rows:   list of (spider, query, location, url keys of the first result page, timestamp ID of the crawl)
+    commit: if false, the transaction is left open for the caller to commit. Default is True"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    string = "INSERT OR REPLACE INTO " + WATERMARKS_TABLE + " VALUES (?,?,?,?,?)"
+    with (conn if commit else contextlib.nullcontext()):
+        conn.executemany(string, [(spider, query, location, '\n'.join(keys), int(date))\
+                                  for spider, query, location, keys, date in rows])
 def del_rows(dates, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     """Deletes the rows matching the dates"""
-    close_conn = False
     if conn == False: 
-        conn = connect(dbase_file)
-        closeconn = True
+        conn = get_conn(dbase_file)
 
     c = conn.cursor()
 
@@ -291,23 +610,123 @@ def del_rows(dates, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     c.execute(string)
     conn.commit()
     
-    if close_conn:
-        conn.close()
 def vacuum(tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     """Vacuums the database"""
-    close_conn = False
     if conn == False: 
-        conn = connect(dbase_file)
-        closeconn = True
+        conn = get_conn(dbase_file)
 
     c = conn.cursor()
     string = "VACUUM"
     c.execute(string)
     conn.commit()
     
-    if close_conn:
+
+
+class Writer(threading.Thread):
+    """Single writer thread of a db file. Row batches are submitted from any thread without blocking it, e.g. the twisted reactor, and committed by this thread only, such that writers never fight over the db lock. The batches queued while a group is written are committed together in the next transaction. Readers are never blocked thanks to WAL"""
+    def __init__(self, dbase_file=DEF_DB, max_group=64, max_delay=0.0):
+        """Initializes the writer. It still has to be started
+        dbase_file: string of the db file. Default is module.DEF_DB
+        max_group:  maximum number of batches committed in a single transaction. Default is 64
+        max_delay:  time in seconds the writer waits for more batches before committing a group. Waiting only delays the commits, since the batches pile up anyway while a group is written: see benchmark.bench_writer. Default is 0.0"""
+        super().__init__(name='juntdb-writer', daemon=True)
+        self.dbase_file = dbase_file
+        self.max_group = max_group
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.commits = 0
+        self.batches = 0
+        self.rows = 0
+
+    def submit(self, fct, *args, **kwargs):
+        """Queues a write. fct is called by the writer thread with the conn and commit=False keyword arguments, in the instrument scope of the caller
+        fct: juntdb write function, e.g. add_many or update_many
+
+        returns: concurrent.futures.Future of the output of fct"""
+        future = concurrent.futures.Future()
+        self.queue.put((future, fct, args, kwargs, instrument.current_scope()))
+        return future
+
+    def add_many(self, rows, **kwargs):
+        """Queues juntdb.add_many(rows, **kwargs)"""
+        return self.submit(add_many, rows, **kwargs)
+
+    def update_many(self, rows, collist, **kwargs):
+        """Queues juntdb.update_many(rows, collist, **kwargs)"""
+        return self.submit(update_many, rows, collist, **kwargs)
+
+    def close(self):
+        """Commits the pending batches and stops the writer thread"""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        conn = connect(self.dbase_file)
+        stop = False
+        while not stop:
+            group = [self.queue.get()]
+            # Gather the batches submitted in the meantime
+            while group[-1] is not None and len(group) < self.max_group:
+                try:
+                    group.append(self.queue.get(timeout=self.max_delay))
+                except queue.Empty:
+                    break
+            if group[-1] is None:
+                stop = True
+                group.pop()
+            if group:
+                self.write_group(conn, group)
         conn.close()
 
+    def write_group(self, conn, group):
+        """Writes all the batches of the group in one transaction. If any of them fails, they are retried one transaction each such that only the faulty batch reports an error"""
+        started = instrument.start()
+        try:
+            with conn:
+                outputs = []
+                for _, fct, args, kwargs, scope in group:
+                    with instrument.scope(scope):
+                        outputs.append(fct(*args, conn=conn, commit=False, **kwargs))
+        except Exception as e:
+            # The columns added by the batches were rolled back with them
+            getattr(conn, 'schema_cache', {}).clear()
+            if len(group) == 1:
+                group[0][0].set_exception(e)
+            else:
+                for job in group:
+                    self.write_group(conn, [job])
+            return
+
+        instrument.stop('db_commit', started)
+        # The commit is shared by the scopes of the batches, e.g. the crawlers that submitted them
+        for scope in {id(x[4]):x[4] for x in group if x[4] is not None}.values():
+            instrument.stop('db_commit', started, scope)
+        self.commits += 1
+        for (future, _, args, _, _), output in zip(group, outputs):
+            self.batches += 1
+            self.rows += len(args[0])
+            future.set_result(output)
+
+WRITERS = {}
+def get_writer(dbase_file=DEF_DB):
+    """Returns the running Writer of the db file for this process, starting it on first use"""
+    with POOL_LOCK:
+        writer = WRITERS.get(dbase_file)
+        if writer is None or not writer.is_alive() or writer.pid != os.getpid():
+            writer = Writer(dbase_file)
+            writer.pid = os.getpid()
+            writer.start()
+            WRITERS[dbase_file] = writer
+    return writer
+def close_writers():
+    """Stops the writers of this process once their queued batches are committed"""
+    for writer in list(WRITERS.values()):
+        if writer.pid == os.getpid():
+            writer.close()
+    WRITERS.clear()
+atexit.register(close_writers)
+
 
 #--------------------
 # FETCHING FUNCTIONS
@@ -318,10 +737,8 @@ def fetch_matching(entry_dict, collist=None, tn=DEF_TABLE, dbase_file=DEF_DB, co
     """Fetches the rows that matches the entry dict.
     If get_data = False, then it only outputs the dates (not the full row): """
 
-    close_conn = False
     if conn == False: 
-        conn = connect(dbase_file)
-        closeconn = True
+        conn = get_conn(dbase_file)
 
     c = conn.cursor()
 
@@ -356,18 +773,33 @@ def fetch_matching(entry_dict, collist=None, tn=DEF_TABLE, dbase_file=DEF_DB, co
     cursor = c.execute(string)
 
     
-    if close_conn:
-        conn.close()
 
     return cursor.fetchall()
+def fetch_existing(col, values, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
+    """Checks in batch which values are present in the column. Fast when the column is indexed
+    col:    column name
+    values: iterable of values to look for
+
+    returns: set of the values present in the table"""
+    if conn == False: 
+        conn = get_conn(dbase_file)
+
+    values = list(values)
+    found = set()
+    c = conn.cursor()
+    # Stay under the sqlite limit of host parameters
+    for k in range(0, len(values), 500):
+        chunk = values[k:k+500]
+        string = "SELECT " + col + " FROM " + tn + " WHERE " + col + " IN (" + ','.join('?'*len(chunk)) + ")"
+        found.update(x[0] for x in c.execute(string, chunk))
+
+    return found
 def fetchone(date, column , tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     return fetch_cols(date, [column] , tn=tn, dbase_file=dbase_file, conn=conn)[0]
 def fetch_range(dates, collist , tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     """Fetches the columns corresponding to the list of dates"""
-    close_conn = False
     if conn == False: 
-        conn = connect(dbase_file)
-        closeconn = True
+        conn = get_conn(dbase_file)
 
     c = conn.cursor()
 
@@ -390,8 +822,6 @@ def fetch_range(dates, collist , tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     output = cursor.fetchall()
 
     
-    if close_conn:
-        conn.close()
 
     if len(output[0])==1:
         output = [x[0] for x in output]
@@ -399,10 +829,8 @@ def fetch_range(dates, collist , tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     return output
 def fetch_cols(date, collist , tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     """Fetches the columns in collist"""
-    close_conn = False
     if conn == False: 
-        conn = connect(dbase_file)
-        closeconn = True
+        conn = get_conn(dbase_file)
 
     c = conn.cursor()
 
@@ -410,16 +838,12 @@ def fetch_cols(date, collist , tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     string = "SELECT " + colstring + " FROM " + tn + " WHERE date = " + str(date)
     c.execute(string)
     
-    if close_conn:
-        conn.close()
 
     return c.fetchall()[0]
 def fetch_last_n(n, collist=None, asdict=False, tn=DEF_TABLE, dbase_file=DEF_DB, conn=False):
     """Fetches the n most recent entries in the table"""
-    close_conn = False
     if conn == False: 
-        conn = connect(dbase_file)
-        closeconn = True
+        conn = get_conn(dbase_file)
 
     c = conn.cursor()
 
@@ -441,8 +865,6 @@ def fetch_last_n(n, collist=None, asdict=False, tn=DEF_TABLE, dbase_file=DEF_DB,
         output = [ dict(zip(colname, r)) for r in cursor.fetchall() ]
 
     
-    if close_conn:
-        conn.close()
 
     return output
 def fetch_last_n_dates(n, **kwargs):
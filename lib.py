@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 """Various routines to interface with junthelper"""
 
+import re
 import juntdb
-import webscraper as webs
+import scorer
+import neardup
+import instrument
 import webbrowser
 import logging
-from pagescraper import Jentry
+import collections
+import multiprocessing
+from pagescraper import Jentry, score_bodystring, bodystring_hash, TokenCache
 
+# Rows of each scorefile version that scored entries of the db
+SCOREFILE_VERSIONS_TABLE = 'scorefile_versions'
 
 
 
@@ -17,6 +24,9 @@ def exec_crawl(input_query, max_age, location):
     max_age:      maximum age (in days) of the job postings to save to disk
     location:     string of the city or other geographical location to search for
     """
+    # scrapy is slow to import, and only needed here
+    import webscraper as webs
+    started = instrument.start()
 
     if type(input_query) != type(list()):
         querylist = [input_query]
@@ -30,6 +40,8 @@ def exec_crawl(input_query, max_age, location):
                 (webs.SpiderCareerjetCa, (query,), {'max_age':max_age, 'location':location})
                 ]
     webs.crawl_many(input_list)
+    instrument.stop('crawl', started)
+    instrument.dump(instrument.CRAWL_DUMP_FILE)
 
 def fetch_scored_jentries(min_score, filter_viewed=True, filter_dead=True, conn=False):
     """Fetches the high scoring entries
@@ -38,10 +50,8 @@ def fetch_scored_jentries(min_score, filter_viewed=True, filter_dead=True, conn=
     is_alive:    only fetch non-dead entries. If false, disregards the "dead" field in juntdb
 
     returns: list of sqlite rows matching the input parameters"""
-    close_conn = False
     if conn == False: 
-        conn = juntdb.connect()
-        closeconn = True
+        conn = juntdb.get_conn()
 
     c = conn.cursor()
 
@@ -53,11 +63,82 @@ def fetch_scored_jentries(min_score, filter_viewed=True, filter_dead=True, conn=
 
     cursor = c.execute(query)
     
-    if close_conn:
-        conn.close()
 
     return row2jentry(cursor.fetchall())
 
+def search(keywords, min_score=None, match_all=True, filter_viewed=True, filter_dead=True, limit=None, conn=False):
+    """Finds the entries whose processed tokens contain the keywords, through the FTS5 index of juntdb
+    keywords:      string of the words to search. Words enclosed in double quotes are searched as a phrase. They are stemmed like the job postings
+    min_score:     minimum score to fetch. If None, the score is disregarded. Default is None
+    match_all:     if true, all the words and phrases must be present. If false, any of them. Default is True
+    filter_viewed: only fetch unviewed entries. Default is True
+    filter_dead:   only fetch non-dead entries. Default is True
+    limit:         maximum number of entries to fetch. If None, all of them. Default is None
+
+    returns: list of Jentry objects, by decreasing score"""
+    if conn == False: 
+        conn = juntdb.get_conn()
+    juntdb.init_fts(conn=conn)
+
+    query = fts_keywords_query(keywords, match_all)
+    if not query:
+        return []
+
+    # Build query string
+    fts = juntdb.fts_name()
+    string = "SELECT t.* FROM " + fts + " JOIN " + juntdb.DEF_TABLE + " t ON t.date = " + fts + ".rowid" + \
+             " WHERE " + fts + " MATCH ?"
+    params = [query]
+    if min_score is not None:
+        string += ' AND t.score >= ?'
+        params.append(min_score)
+    if filter_viewed: string += ' AND t.viewed=0'
+    if filter_dead:   string += ' AND t.dead=0'
+    string += ' ORDER BY t.score DESC'
+    if limit is not None:
+        string += ' LIMIT ?'
+        params.append(limit)
+
+    return row2jentry(conn.execute(string, params).fetchall())
+
+def fts_keywords_query(keywords, match_all=True):
+    """Converts the keywords of search into an FTS5 query string
+    keywords:  string of the words to search. Words enclosed in double quotes are searched as a phrase
+    match_all: if true, all the words and phrases must be present. If false, any of them. Default is True
+
+    returns: query string, or '' if no keyword survives the stemming"""
+    phrases = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', keywords):
+        tokens = scorer.stem_and_discard(re.findall(r'[a-z0-9]+', (phrase or word).lower())).split()
+        if tokens:
+            phrases.append('"' + ' '.join(tokens) + '"')
+    return (' AND ' if match_all else ' OR ').join(phrases)
+
+def fts_rule_hits(conn=False):
+    """Evaluates every scorefile row inside the db. The rows are matched as FTS5 queries on the processed tokens, or with their regex when rule_fts_query cannot express them
+    conn: sqlite connection object to use. If False, the pooled juntdb connection is used
+
+    returns: dict of date -> sorted list of the indexes of the scorefile rows hitting that entry"""
+    if conn == False: 
+        conn = juntdb.get_conn()
+    juntdb.init_fts(conn=conn)
+    conn.create_function('regexp', 2, lambda pattern, text: text is not None and re.search(pattern, text) is not None,\
+                         deterministic=True)
+
+    fts = juntdb.fts_name()
+    hits = collections.defaultdict(list)
+    for k, (_, _, _, alternatives) in enumerate(scorer.REGEX_LIST):
+        query = scorer.rule_fts_query(alternatives)
+        if query is None:
+            string = "SELECT date FROM " + juntdb.DEF_TABLE + " WHERE " + juntdb.FTS_COL + " REGEXP ?"
+            params = (scorer.REGEX_LIST[k][0].pattern,)
+        else:
+            string = "SELECT rowid FROM " + fts + " WHERE " + fts + " MATCH ?"
+            params = (query,)
+        for (date,) in conn.execute(string, params):
+            hits[date].append(k)
+    return hits
+
 def sort_by_attribute(lst, attribute):
     """Sort the list of namedtuples by the specified attibute
     attribute: string of the sorting attribute"""
@@ -68,19 +149,44 @@ def sort_by_attribute(lst, attribute):
     else:
         return lst
 
-def score_db(conn=False):
-    """Scores all unscored entries in db
-    conn: sqlite connection object to use. If False, a new connection is made"""
-    # TODO: this is a really inefficient way to score
-    # it typecasts the sqlite output to a Jentry, then scores that, instead of scoring the sqlite row directly
-    close_conn = False
+def score_db(conn=False, batch=True, chunk_size=1000, workers=1, use_fts=False, use_matrix=False):
+    """Scores all unscored entries in db, then updates the entries scored with another version of scorefile.csv
+    conn:       sqlite connection object to use. If False, the pooled juntdb connection is used, and the scores are written by the juntdb writer thread shared with the crawl
+    batch:      if true, scores the date and bodystring columns directly, one transaction per chunk. If false, goes through Jentry objects. Default is True
+    chunk_size: number of rows per transaction in batch mode. Default is 1000
+    workers:    number of processes scoring the chunks in batch mode. Default is 1
+    use_fts:    if true, the entries scored with another scorefile version are rescored inside the db by fts_rule_hits. Default is False
+    use_matrix: if true, the entries scored with another scorefile version are rescored by chunks with a scorer.RuleMatrix. Default is False"""
+    started = instrument.start()
+    writer = None
     if conn == False: 
-        conn = juntdb.connect()
-        closeconn = True
+        conn = juntdb.get_conn()
+        writer = juntdb.get_writer()
+
+    register_scorefile_version(conn)
+    add_score_cols(conn)
+    juntdb.init_fts(conn=conn)
+    if batch:
+        score_db_batch(conn, chunk_size, workers, writer)
+    else:
+        score_db_jentries(conn)
+    rescore_db(conn, chunk_size, writer, use_fts, use_matrix)
+
+    # Keep the stems for the next run
+    scorer.STEM_CACHE.save()
+    logging.info('Stem cache: ' + str(scorer.STEM_CACHE.stats()))
+    instrument.stop('score_db', started)
+    instrument.dump(instrument.SCORE_DUMP_FILE)
+
 
+def score_db_jentries(conn):
+    """Scores all unscored entries in db by building a Jentry for each row. Slow, but goes through Jentry.write_db
+    conn: sqlite connection object to use"""
     c = conn.cursor()
-    string = "SELECT * FROM " + juntdb.DEF_TABLE + " WHERE (score IS NULL AND dead=0)"
-    c.execute(string)
+    string = "SELECT * FROM " + juntdb.DEF_TABLE + " WHERE (score IS NULL AND dead=0"
+    if neardup.DUPLICATE_COL in juntdb.get_cols(conn=conn):
+        string += ' AND ' + neardup.DUPLICATE_COL + ' IS NULL'
+    c.execute(string + ')')
     jentries = row2jentry(c.fetchall())
     if not jentries:
         print('No entries to score')
@@ -91,8 +197,231 @@ def score_db(conn=False):
         jentry.compute_score()
         jentry.write_db(conn)
 
-    if close_conn:
-        conn.close()
+def score_db_batch(conn, chunk_size=1000, workers=1, writer=None):
+    """Scores all unscored entries in db. Only the date and bodystring are read, and the results are written back by chunks
+    conn:       sqlite connection object to use
+    chunk_size: number of rows per transaction. Default is 1000
+    workers:    number of processes scoring the chunks. All writes are done by the calling process. Default is 1
+    writer:     juntdb.Writer to submit the chunks to. If None, they are written with conn. Default is None"""
+    add_score_cols(conn)
+    score_cols = ['score', 'score_hits', 'processed_tokens', 'scorefile_version']
+    version = scorer.SCOREFILE_VERSION
+
+    # Bodystrings already seen, e.g. reposts or mirrors, are not processed again. Repeats of a bodystring being processed, in the same chunk or in a chunk still in flight, are deferred until its tokens are stored
+    token_cache = TokenCache(conn, writer)
+    def prepare(rows):
+        hashes = [bodystring_hash(bodystring) for _, bodystring in rows]
+        cached = token_cache.lookup(hashes)
+        prepared, deferred = [], []
+        missed = set()
+        for (date, bodystring), h in zip(rows, hashes):
+            if cached.get(h) is not None:
+                prepared.append((date, None, cached[h], h))
+            elif h in cached or h in missed:
+                deferred.append((date, bodystring, h))
+            else:
+                missed.add(h)
+                prepared.append((date, bodystring, None, h))
+        return [row[:3] for row in prepared], [row[3] for row in prepared], deferred
+
+    # Chunks submitted to the writer are committed while the next ones are scored
+    submitted = []
+    def write(scored, prepared, hashes, deferred):
+        token_cache.store([(h, row[3]) for h, row, (_, _, cached) in zip(hashes, scored, prepared) if cached is None])
+        # Chunks are written in the order they were read, so the deferred tokens are stored by now
+        scored += score_rows([(date, bodystring, token_cache.get(h)) for date, bodystring, h in deferred])
+        scored = [row + (version,) for row in scored]
+        if writer is None:
+            juntdb.update_many(scored, score_cols, conn=conn)
+        else:
+            submitted.append(writer.update_many(scored, score_cols))
+        return len(scored)
+
+    # Near-duplicates keep a NULL score, see neardup
+    where = 'score IS NULL AND dead=0'
+    if neardup.DUPLICATE_COL in juntdb.get_cols(conn=conn):
+        where += ' AND ' + neardup.DUPLICATE_COL + ' IS NULL'
+
+    count = 0
+    chunks = fetch_chunks(conn, ['bodystring'], where, [], chunk_size)
+    if workers > 1:
+        # Keep a few chunks in flight per worker; the results are written in the order they were read
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(instrument.ENABLED,))
+        pending = collections.deque()
+        def collect():
+            result, prepared, hashes, deferred = pending.popleft()
+            scored, stems, stages = result.get()
+            scorer.STEM_CACHE.merge(stems)
+            instrument.merge(stages)
+            return write(scored, prepared, hashes, deferred)
+        try:
+            for rows in chunks:
+                prepared, hashes, deferred = prepare(rows)
+                pending.append((pool.apply_async(score_rows_worker, (prepared,)), prepared, hashes, deferred))
+                if len(pending) >= 2*workers:
+                    count += collect()
+            while pending:
+                count += collect()
+        finally:
+            pool.terminate()
+    else:
+        for rows in chunks:
+            prepared, hashes, deferred = prepare(rows)
+            count += write(score_rows(prepared), prepared, hashes, deferred)
+    for future in submitted:
+        future.result()
+    token_cache.flush()
+
+    if not count:
+        print('No entries to score')
+    else:
+        print('Scored ' + str(count)  +' job postings')
+        stats = token_cache.stats()
+        print('Token cache: ' + str(stats['hits']) + ' hits, ' + str(stats['misses']) + ' misses, ' + \
+              str(stats['size']) + ' entries')
+
+def dedup_db(threshold=neardup.DEF_THRESHOLD, chunk_size=1000, conn=False):
+    """Flags the near-duplicates among the entries that were never checked, e.g. added before the detection existed. Entries are checked by increasing date, such that the oldest copy is kept
+    threshold:  similarity above which an entry is flagged, see neardup.NearDupIndex. Default is neardup.DEF_THRESHOLD
+    chunk_size: number of rows per transaction. Default is 1000
+    conn:       sqlite connection object to use. If False, the pooled juntdb connection is used"""
+    if conn == False: 
+        conn = juntdb.get_conn()
+    index = neardup.NearDupIndex(threshold, conn=conn)
+
+    count = 0
+    where = neardup.DUPLICATE_COL + ' IS NULL AND date NOT IN (SELECT date FROM ' + neardup.SIGNATURES_TABLE + ')'
+    for rows in fetch_chunks(conn, ['bodystring'], where, [], chunk_size):
+        count += len(index.flag(rows))
+
+    if count:
+        print('Flagged ' + str(count) + ' near-duplicate job postings')
+
+def rescore_db(conn, chunk_size=1000, writer=None, use_fts=False, use_matrix=False):
+    """Updates the entries scored with another version of scorefile.csv. Their stored processed_tokens are only matched against the scorefile rows that were added since; a pure reweight just recomputes the totals
+    conn:       sqlite connection object to use
+    chunk_size: number of rows per transaction. Default is 1000
+    writer:     juntdb.Writer to submit the chunks to. If None, they are written with conn. Default is None
+    use_fts:    if true, every scorefile row is matched inside the db by fts_rule_hits instead. Default is False
+    use_matrix: if true, each chunk is scored at once by a scorer.RuleMatrix. Entries of a version with the same scorefile rows keep their hits. Default is False"""
+    add_score_cols(conn)
+    score_cols = ['score', 'score_hits', 'scorefile_version']
+    version = scorer.SCOREFILE_VERSION
+    versions = fetch_scorefile_versions(conn)
+    rules = set(scorer.RULES)
+    fts_hits = None
+
+    count = 0
+    submitted = []
+    where = 'score IS NOT NULL AND processed_tokens IS NOT NULL AND dead=0 AND ' + \
+            '(scorefile_version IS NULL OR scorefile_version != ?)'
+    for rows in fetch_chunks(conn, ['processed_tokens', 'score_hits', 'scorefile_version'], where, [version], chunk_size):
+        if use_fts and fts_hits is None:
+            fts_hits = fts_rule_hits(conn)
+        if use_matrix:
+            known = [score_hits if score_hits is not None and versions.get(old_version) == rules else None\
+                     for _, _, score_hits, old_version in rows]
+            matrix = scorer.RuleMatrix([processed_tokens for _, processed_tokens, _, _ in rows], known)
+            rescored = [(row[0], score, score_hits, version) for row, score, score_hits in\
+                        zip(rows, matrix.scores().tolist(), matrix.hit_lists())]
+        elif use_fts:
+            rescored = []
+            for date, _, _, _ in rows:
+                score, score_hits = 0, []
+                for k in fts_hits.get(date, []):
+                    _, regex_string, row_score, _ = scorer.REGEX_LIST[k]
+                    score += row_score
+                    score_hits.append((regex_string, row_score))
+                rescored.append((date, score, score_hits, version))
+        else:
+            # Entries of an unknown version have all the scorefile rows matched again
+            rescored = []
+            for date, processed_tokens, score_hits, old_version in rows:
+                score, score_hits = scorer.rescore(processed_tokens, score_hits or [], versions.get(old_version))
+                rescored.append((date, score, score_hits, version))
+        if writer is None:
+            juntdb.update_many(rescored, score_cols, conn=conn)
+        else:
+            submitted.append(writer.update_many(rescored, score_cols))
+        count += len(rescored)
+    for future in submitted:
+        future.result()
+
+    if count:
+        print('Rescored ' + str(count)  +' job postings for the current scorefile')
+
+def add_score_cols(conn):
+    """Adds the columns written by the scoring to the db, if they are missing. Their types match what juntdb.add would infer from a scored Jentry
+    conn: sqlite connection object to use"""
+    score_cols = ['score', 'score_hits', 'processed_tokens', 'scorefile_version']
+    score_types = ['REAL', 'LIST', 'TEXT', 'TEXT']
+    dbcols = juntdb.get_cols(conn=conn)
+    missing = [(cn, ct) for cn, ct in zip(score_cols, score_types) if cn not in dbcols]
+    if missing:
+        juntdb.add_cols(*zip(*missing), conn=conn)
+
+def register_scorefile_version(conn):
+    """Records the rows of the current scorefile version, such that rescore_db can tell which rows were added since an entry was scored
+    conn: sqlite connection object to use"""
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS " + SCOREFILE_VERSIONS_TABLE + " (version TEXT PRIMARY KEY, rules LIST)")
+        conn.execute("INSERT OR IGNORE INTO " + SCOREFILE_VERSIONS_TABLE + " (version, rules) VALUES (?,?)",\
+                     (scorer.SCOREFILE_VERSION, scorer.RULES))
+
+def fetch_scorefile_versions(conn):
+    """Returns a dict of the recorded scorefile versions to the set of their rows
+    conn: sqlite connection object to use"""
+    cursor = conn.execute("SELECT version, rules FROM " + SCOREFILE_VERSIONS_TABLE)
+    return {version: set(rules) for version, rules in cursor.fetchall()}
+
+def fetch_chunks(conn, collist, where, params, chunk_size):
+    """Generator of the rows of the db matching the where clause, by increasing date
+    conn:       sqlite connection object to use
+    collist:    list of the columns to fetch, after the date
+    where:      string of the sql condition on the rows
+    params:     list of the parameters of the where clause
+    chunk_size: maximum number of rows per chunk
+
+    yields: list of (date, value of collist[0], ...)"""
+    c = conn.cursor()
+    string = "SELECT date, " + ', '.join(collist) + " FROM " + juntdb.DEF_TABLE + \
+             " WHERE (" + where + ") AND date > ? ORDER BY date LIMIT ?"
+
+    # Restart after the last date of the previous chunk, such that already processed rows are never read again
+    last_date = -1
+    while True:
+        rows = c.execute(string, list(params) + [last_date, chunk_size]).fetchall()
+        if not rows:
+            break
+        last_date = rows[-1][0]
+        yield rows
+
+def score_rows(rows):
+    """Scores the raw db rows. Module level such that it can be sent to worker processes
+    rows: iterable of (date, bodystring, processed tokens). If the processed tokens are not None, the bodystring is not processed again
+
+    returns: list of (date, score, score hits, processed tokens)"""
+    scored = []
+    for date, bodystring, processed_tokens in rows:
+        if processed_tokens is None:
+            scored.append((date,) + score_bodystring(bodystring))
+        else:
+            scored.append((date,) + scorer.score(processed_tokens) + (processed_tokens,))
+    return scored
+
+def init_worker(instrumented=False):
+    """Initializer of the scoring processes of score_db_batch
+    instrumented: whether to record the stages, as in the parent process. Default is False"""
+    scorer.load()
+    scorer.STEM_CACHE.record_new()
+    instrument.enable(instrumented)
+    instrument.reset()
+
+def score_rows_worker(rows):
+    """score_rows in a scoring process. The stems it computed and its stages are sent back with the scores, since only the cache and the stages of the parent process are saved
+
+    returns: (output of score_rows, output of scorer.STEM_CACHE.pop_new, output of instrument.drain)"""
+    return score_rows(rows), scorer.STEM_CACHE.pop_new(), instrument.drain()
 
 def row2jentry(data):
     """Converts the output of sqlite into Jentry objects
@@ -131,11 +460,10 @@ def open_in_browser(jentries, mark_as_viewed=True):
     """Opens the jentries in browser
     jentries:       iterable of Jentry objects
     mark_as_viewed: if true, marks the Jentry as viewed in the db file"""
-    conn = juntdb.connect() 
+    conn = juntdb.get_conn()
     for jentry in jentries:
         webbrowser.open(jentry.url)
         if mark_as_viewed:
             jentry.viewed = True
-            jentry.write_db()
-    conn.close()
+            jentry.write_db(conn)
 
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""Local stand-in for the job aggregation websites. Serves paginated result pages with the markup parsed by webscraper.SpiderIndeedCa and webscraper.SpiderCareerjetCa, and their posting pages, with configurable latency and error rate"""
+
+import time
+import random
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import scorer
+
+
+# Default values
+DEF_PORT = 8765
+DEF_RESULT_PAGES = 5  # Number of result pages of each search
+DEF_PER_PAGE = 20     # Number of postings per result page
+DEF_LATENCY = 0.0     # Seconds of delay of each response
+DEF_ERROR_RATE = 0.0  # Probability that a response is a 503 error
+DEF_RETRY_AFTER = None # Retry-After header of the 503 errors, in seconds
+DEF_SHARED_RATE = 0.0  # Share of the postings found by every search
+
+
+class MockBoard(ThreadingHTTPServer):
+    """HTTP server of the mock job board. The content only depends on the url and on the postings published since the start, such that every run crawls the same postings"""
+    daemon_threads = True
+
+    def __init__(self, port=DEF_PORT, result_pages=DEF_RESULT_PAGES, per_page=DEF_PER_PAGE, latency=DEF_LATENCY,\
+                 error_rate=DEF_ERROR_RATE, retry_after=DEF_RETRY_AFTER, shared_rate=DEF_SHARED_RATE, seed=0):
+        """Binds the server to localhost. It serves once start() is called
+        port:         int of the port to listen on. 0 picks a free one. Default is module.DEF_PORT
+        result_pages: number of result pages of each search. Default is module.DEF_RESULT_PAGES
+        per_page:     number of postings per result page. Default is module.DEF_PER_PAGE
+        latency:      delay in seconds of each response. Default is module.DEF_LATENCY
+        error_rate:   probability that a response is a 503 error. Default is module.DEF_ERROR_RATE
+        retry_after:  int of the Retry-After header of the 503 errors, in seconds. None omits it. Default is module.DEF_RETRY_AFTER
+        shared_rate:  share of the postings found by every search, as when the searched words overlap. Default is module.DEF_SHARED_RATE
+        seed:         random seed of the errors. Default is 0"""
+        super().__init__(('127.0.0.1', port), MockBoardHandler)
+        self.result_pages = result_pages
+        self.per_page = per_page
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.shared_rate = shared_rate
+        self.published = 0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        with open(scorer.LINUX_WORDS_FILE) as f:
+            self.words = f.read().split()
+        self.reset_counts()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1])
+
+    def start(self):
+        """Serves in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = {'result_pages':0, 'posting_pages':0, 'errors':0, 'not_found':0}
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def publish(self, n_postings):
+        """Adds new postings at the top of the results of every search, pushing the others down
+        n_postings: number of new postings"""
+        with self.lock:
+            self.published += n_postings
+
+    def posting_number(self, page, index):
+        """Number of the posting at the given position of the results. The postings published later have higher numbers"""
+        return self.published - page*self.per_page - index
+
+    def posting_id(self, site, query, number):
+        """Id of a posting of a search. The shared ones have the same id in every search"""
+        if random.Random(number).random() < self.shared_rate:
+            query = {}
+        return posting_hash(site, query, number)
+
+    def is_error(self):
+        with self.lock:
+            return self.rng.random() < self.error_rate
+
+    def posting_body(self, posting_id):
+        """Builds the text of a posting, seeded by its id"""
+        rng = random.Random(posting_id)
+        paragraphs = [' '.join(rng.choice(self.words) for _ in range(rng.randint(20, 80))) for _ in range(6)]
+        return ''.join('<p>' + x + '</p>' for x in paragraphs)
+
+    def indeed_results(self, query, page):
+        """Result page of indeed.ca. The pagination ends with a 'Next »' link, except on the last page"""
+        rows = []
+        for k in range(self.per_page):
+            posting_id = self.posting_id('indeed', query, self.posting_number(page, k))
+            rows.append('<div class="row result"><h2 class="jobtitle"><a href="/viewjob?jk=' + posting_id + '">Job ' +\
+                        posting_id + '</a></h2><span class="company">Company</span><span class="location">' +\
+                        '<span itemprop="addressLocality">Montreal</span></span></div>')
+        links = ['<a href="/jobs?' + urlencode(dict(query, start=self.per_page*p)) + '"><span>' + str(p+1) + '</span></a>'\
+                 for p in range(page)]
+        if page + 1 < self.result_pages:
+            links.append('<a href="/jobs?' + urlencode(dict(query, start=self.per_page*(page+1))) + '"><span>Next\xa0»</span></a>')
+        return '<html><body><td id="resultsCol">' + ''.join(rows) + '<div class="pagination">' + ''.join(links) +\
+               '</div></td></body></html>'
+
+    def careerjet_results(self, query, page):
+        """Result page of careerjet.ca. The postings are dated today, and the browse links end with ' >>', except on the last page"""
+        date = datetime.today().strftime('%B %d')
+        jobs = []
+        for k in range(self.per_page):
+            posting_id = self.posting_id('careerjet', query, self.posting_number(page, k))
+            jobs.append('<div class="job"><h2><a href="/jobad/ca' + posting_id + '">Job ' + posting_id + '</a></h2><p>' +\
+                        '<span class="date_compact"><script>document.write(df("' + date + '"))</script></span>' +\
+                        '<a class="locations_compact">Montreal</a></p></div>')
+        links = ['<a href="/wsearch/jobs?' + urlencode(dict(query, p=p+1)) + '">' + str(p+1) + '</a>' for p in range(page)]
+        if page + 1 < self.result_pages:
+            links.append('<a href="/wsearch/jobs?' + urlencode(dict(query, p=page+2)) + '"> >></a>')
+        return '<html><body>' + ''.join(jobs) + '<p class="browse">' + ''.join(links) + '</p></body></html>'
+
+    def posting_page(self, posting_id):
+        """Posting page, with the markup of indeed.ca"""
+        return '<html><head><title>Job ' + posting_id + '</title></head><body><b class="jobtitle">Job ' + posting_id +\
+               '</b><span id="job_summary" class="summary">' + self.posting_body(posting_id) + '</span></body></html>'
+
+def posting_hash(site, query, number):
+    """Id of a posting of a search, the same on every run"""
+    key = repr((site, sorted(query.items()), number))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()
+
+class MockBoardHandler(BaseHTTPRequestHandler):
+    """Request handler of MockBoard"""
+    def do_GET(self):
+        board = self.server
+        if board.latency:
+            time.sleep(board.latency)
+        if board.is_error():
+            board.count('errors')
+            headers = {} if board.retry_after is None else {'Retry-After':str(board.retry_after)}
+            self.respond(503, '<html><body>Service Unavailable</body></html>', headers)
+            return
+
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        if parsed.path == '/jobs':
+            page = int(query.pop('start', 0))//board.per_page
+            board.count('result_pages')
+            self.respond(200, board.indeed_results(query, page))
+        elif parsed.path == '/wsearch/jobs':
+            page = int(query.pop('p', 1)) - 1
+            board.count('result_pages')
+            self.respond(200, board.careerjet_results(query, page))
+        elif parsed.path == '/viewjob':
+            board.count('posting_pages')
+            self.respond(200, board.posting_page(query.get('jk', '')))
+        elif parsed.path.startswith('/jobad/ca'):
+            board.count('posting_pages')
+            self.respond(200, board.posting_page(parsed.path[len('/jobad/ca'):]))
+        else:
+            board.count('not_found')
+            self.respond(404, '<html><body>Not Found</body></html>')
+
+    def respond(self, status, page, headers={}):
+        body = page.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local mock of the job aggregation websites crawled by webscraper')
+    parser.add_argument('--port', type=int, default=DEF_PORT)
+    parser.add_argument('--result-pages', type=int, default=DEF_RESULT_PAGES, help='number of result pages of each search')
+    parser.add_argument('--per-page', type=int, default=DEF_PER_PAGE, help='number of postings per result page')
+    parser.add_argument('--latency', type=float, default=DEF_LATENCY, help='delay in seconds of each response')
+    parser.add_argument('--error-rate', type=float, default=DEF_ERROR_RATE, help='probability that a response is a 503 error')
+    parser.add_argument('--retry-after', type=int, default=DEF_RETRY_AFTER, help='Retry-After header of the 503 errors, in seconds')
+    parser.add_argument('--shared-rate', type=float, default=DEF_SHARED_RATE, help='share of the postings found by every search')
+    args = parser.parse_args()
+
+    board = MockBoard(args.port, args.result_pages, args.per_page, args.latency, args.error_rate, args.retry_after, args.shared_rate)
+    print('Serving the mock job board on ' + board.base_url)
+    try:
+        board.serve_forever()
+    except KeyboardInterrupt:
+        board.server_close()
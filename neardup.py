@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""Near-duplicate detection of job postings. Bodystrings are summarized by MinHash signatures of their word shingles, which are indexed in juntdb by locality sensitive hashing (LSH) bands"""
+
+import re
+import zlib
+import hashlib
+import threading
+import contextlib
+import numpy as np
+import juntdb
+
+
+# Default values
+DEF_THRESHOLD = 0.8 # Estimated Jaccard similarity of the shingles above which two postings are duplicates
+NUM_PERM = 64       # Number of MinHash permutations, i.e. length of the signatures
+SHINGLE_SIZE = 5    # Number of words per shingle
+
+# The signatures are independent of the threshold; the bands are rebuilt from them whenever the LSH parameters change
+SIGNATURES_TABLE = 'minhash_signatures'
+BANDS_TABLE = 'minhash_bands'
+PARAMS_TABLE = 'minhash_params'
+DUPLICATE_COL = 'duplicate_of' # Date of the original posting, or NULL
+
+WORD_REGEX = re.compile(r'\w+')
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+PERMUTATIONS = {}
+
+INDEXES = {}
+INDEXES_LOCK = threading.Lock()
+
+
+def shingle_hashes(bodystring, size=SHINGLE_SIZE):
+    """Hashes the word shingles of a job posting
+    bodystring: string of the job posting
+    size:       number of words per shingle. Default is module.SHINGLE_SIZE
+
+    returns: uint64 array of the 32 bit hashes of the distinct shingles, empty if there are fewer than size words"""
+    words = WORD_REGEX.findall((bodystring or '').lower())
+    shingles = {' '.join(words[k:k+size]) for k in range(len(words) - size + 1)}
+    return np.fromiter((zlib.crc32(s.encode('utf-8', 'surrogatepass')) for s in shingles), dtype=np.uint64)
+
+def get_permutations(num_perm):
+    """Returns the (a, b) arrays of the universal hash functions a*x + b mod MERSENNE_PRIME. Seeded, such that signatures are comparable between runs"""
+    if num_perm not in PERMUTATIONS:
+        rng = np.random.RandomState(1)
+        PERMUTATIONS[num_perm] = (rng.randint(1, int(MERSENNE_PRIME), num_perm, dtype=np.uint64),\
+                                  rng.randint(0, int(MERSENNE_PRIME), num_perm, dtype=np.uint64))
+    return PERMUTATIONS[num_perm]
+
+def signature(bodystring, num_perm=NUM_PERM):
+    """Computes the MinHash signature of a job posting
+    bodystring: string of the job posting
+    num_perm:   number of permutations. Default is module.NUM_PERM
+
+    returns: uint32 array of length num_perm, or None if the posting has fewer than module.SHINGLE_SIZE words, e.g. when its body failed to scrape"""
+    a, b = get_permutations(num_perm)
+    hashes = shingle_hashes(bodystring)
+    if not len(hashes):
+        return None
+    # The products wrap around 2**64; good enough for hashing
+    permuted = np.bitwise_and((np.outer(hashes, a) + b) % MERSENNE_PRIME, MAX_HASH)
+    return permuted.min(axis=0).astype(np.uint32)
+
+def similarity(sig1, sig2):
+    """Estimated Jaccard similarity of the shingles of two signatures"""
+    return float(np.count_nonzero(sig1 == sig2)) / len(sig1)
+
+def lsh_params(threshold, num_perm=NUM_PERM):
+    """Picks the number of bands and rows per band whose LSH threshold (1/bands)**(1/rows) is the closest to the similarity threshold
+    threshold: similarity threshold
+    num_perm:  length of the signatures. Default is module.NUM_PERM
+
+    returns: (bands, rows)"""
+    divisors = [b for b in range(1, num_perm + 1) if num_perm % b == 0]
+    bands = min(divisors, key=lambda b: abs((1/b)**(b/num_perm) - threshold))
+    return bands, num_perm//bands
+
+def get_index(threshold=DEF_THRESHOLD, dbase_file=juntdb.DEF_DB):
+    """Returns the index of the db file shared by the whole process, created on first use"""
+    with INDEXES_LOCK:
+        key = (dbase_file, threshold)
+        if key not in INDEXES:
+            INDEXES[key] = NearDupIndex(threshold, dbase_file=dbase_file)
+        return INDEXES[key]
+
+class NearDupIndex:
+    """LSH index of the MinHash signatures of the postings. A lookup costs one indexed query per posting, whatever the size of the db. The lookups and the index writes are done with the connection of the caller, e.g. in a juntdb.Writer job, such that the index never holds a posting that is not in the db"""
+    def __init__(self, threshold=DEF_THRESHOLD, num_perm=NUM_PERM, dbase_file=juntdb.DEF_DB, conn=False):
+        """Opens the index, creating its tables if necessary
+        threshold:  estimated Jaccard similarity above which two postings are duplicates. Default is module.DEF_THRESHOLD
+        num_perm:   length of the signatures. Default is module.NUM_PERM
+        dbase_file: string of the db file. Default is juntdb.DEF_DB
+        conn:       sqlite connection object used by default. If False, the pooled juntdb connection of the calling thread is used"""
+        self.dbase_file = dbase_file
+        self.conn = conn
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.duplicates = 0
+
+        conn = self.get_conn()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS " + SIGNATURES_TABLE + " (date INTEGER PRIMARY KEY, signature BLOB)")
+            conn.execute("CREATE TABLE IF NOT EXISTS " + BANDS_TABLE + " (key INTEGER, date INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS " + BANDS_TABLE + "_key_idx ON " + BANDS_TABLE + " (key)")
+            conn.execute("CREATE TABLE IF NOT EXISTS " + PARAMS_TABLE + " (num_perm INTEGER, bands INTEGER)")
+        if DUPLICATE_COL not in juntdb.get_cols(conn=conn):
+            juntdb.add_cols([DUPLICATE_COL], ['INTEGER'], conn=conn)
+
+        params = conn.execute("SELECT num_perm, bands FROM " + PARAMS_TABLE).fetchone()
+        if params is not None and params[0] != num_perm:
+            raise ValueError('The index of the db was built with ' + str(params[0]) + ' permutations, not ' + str(num_perm))
+        if params != (num_perm, self.bands):
+            self.rebuild()
+
+    def get_conn(self, conn=False):
+        if conn != False:
+            return conn
+        return juntdb.get_conn(self.dbase_file) if self.conn == False else self.conn
+
+    def band_keys(self, sig):
+        """Returns the list of the bucket keys of the signature, one per band"""
+        keys = []
+        for k in range(self.bands):
+            digest = hashlib.blake2b(sig[k*self.rows:(k+1)*self.rows].tobytes(), digest_size=8, salt=bytes([k])).digest()
+            keys.append(int.from_bytes(digest, 'little', signed=True))
+        return keys
+
+    def query(self, sig, keys=None, conn=False, batch=None):
+        """Finds the most similar indexed posting
+        sig:   signature of the posting
+        keys:  output of band_keys for sig. If None, it is computed. Default is None
+        conn:  sqlite connection object to use. If False, see get_conn
+        batch: dict of band key -> [(date, signature)] of the postings indexed in the current transaction. Default is None
+
+        returns: (date, similarity) of the most similar posting above the threshold, or None"""
+        if keys is None:
+            keys = self.band_keys(sig)
+
+        candidates = {}
+        for key in keys:
+            for date, cand_sig in (batch or {}).get(key, []):
+                candidates[date] = cand_sig
+        string = "SELECT s.date, s.signature FROM " + SIGNATURES_TABLE + " s WHERE s.date IN " + \
+                 "(SELECT date FROM " + BANDS_TABLE + " WHERE key IN (" + ','.join('?'*len(keys)) + "))"
+        for date, blob in self.get_conn(conn).execute(string, keys):
+            candidates[date] = np.frombuffer(blob, dtype=np.uint32)
+
+        best = None
+        for date, cand_sig in candidates.items():
+            sim = similarity(sig, cand_sig)
+            if sim >= self.threshold and (best is None or (sim, -date) > (best[1], -best[0])):
+                best = (date, sim)
+        return best
+
+    def flag(self, entries, conn=False, commit=True):
+        """Looks for a near-duplicate of each entry among the indexed postings and the previous entries. The duplicates are flagged in the db, and the others are added to the index. Entries too short to have a signature are neither, since all empty bodies would match
+        entries: list of (date, bodystring) of rows of the db, by increasing date
+        conn:    sqlite connection object to use. If False, see get_conn
+        commit:  if false, the transaction is left open for the caller to commit. Default is True
+
+        returns: list of (date, date of the original posting) of the duplicates"""
+        conn = self.get_conn(conn)
+        batch = {}
+        flagged = []
+        indexed = []
+        for date, bodystring in entries:
+            sig = signature(bodystring, self.num_perm)
+            if sig is None:
+                continue
+            keys = self.band_keys(sig)
+            found = self.query(sig, keys, conn, batch)
+            if found is not None:
+                flagged.append((date, found[0]))
+                continue
+            for key in keys:
+                batch.setdefault(key, []).append((date, sig))
+            indexed.append((date, sig.tobytes(), keys))
+
+        with (conn if commit else contextlib.nullcontext()):
+            insert_signatures(indexed, conn=conn, commit=False)
+            juntdb.update_many(flagged, [DUPLICATE_COL], conn=conn, commit=False)
+        with self.lock:
+            self.lookups += len(entries)
+            self.duplicates += len(flagged)
+        return flagged
+
+    def add_many(self, rows, conn=False, commit=True, **kwargs):
+        """Adds the rows with juntdb.add_many, then flags the near-duplicates among the inserted ones. Meant to be submitted to the juntdb.Writer, such that the rows and their signatures are committed together, under their final dates
+        rows:   list of data dictionaries, as for juntdb.add_many. The DUPLICATE_COL key of the inserted ones is set
+        conn:   sqlite connection object to use. If False, see get_conn
+        commit: if false, the transaction is left open for the caller to commit. Default is True
+        kwargs: passed to juntdb.add_many, e.g. or_ignore
+
+        returns: number of rows inserted"""
+        conn = self.get_conn(conn)
+        with (conn if commit else contextlib.nullcontext()):
+            count = juntdb.add_many(rows, conn=conn, commit=False, **kwargs)
+            # Rows skipped by a unique index are absent under their date, which add_many made unique
+            dates = [int(item['date']) for item in rows]
+            inserted = set(dates) if count == len(rows) else juntdb.fetch_existing('date', dates, conn=conn)
+            entries = sorted((date, item.get('bodystring')) for date, item in zip(dates, rows) if date in inserted)
+            flagged = dict(self.flag(entries, conn=conn, commit=False))
+        for date, item in zip(dates, rows):
+            if date in inserted:
+                item[DUPLICATE_COL] = flagged.get(date)
+        return count
+
+    def rebuild(self):
+        """Recomputes the bands of all the stored signatures for the current LSH parameters"""
+        conn = self.get_conn()
+        signatures = conn.execute("SELECT date, signature FROM " + SIGNATURES_TABLE).fetchall()
+        rows = [(date, key) for date, blob in signatures for key in self.band_keys(np.frombuffer(blob, dtype=np.uint32))]
+        with conn:
+            conn.execute("DELETE FROM " + BANDS_TABLE)
+            conn.executemany("INSERT INTO " + BANDS_TABLE + " (key, date) VALUES (?,?)", ((key, date) for date, key in rows))
+            conn.execute("DELETE FROM " + PARAMS_TABLE)
+            conn.execute("INSERT INTO " + PARAMS_TABLE + " VALUES (?,?)", (self.num_perm, self.bands))
+
+    def stats(self):
+        """Returns a dict of the lookups, duplicates found and LSH parameters"""
+        return {'lookups':self.lookups, 'duplicates':self.duplicates, 'threshold':self.threshold,\
+                'bands':self.bands, 'rows':self.rows}
+
+def insert_signatures(rows, conn, commit=True):
+    """Inserts (date, signature bytes, band keys) rows in the index tables"""
+    with (conn if commit else contextlib.nullcontext()):
+        conn.executemany("INSERT OR REPLACE INTO " + SIGNATURES_TABLE + " VALUES (?,?)", ((date, sig) for date, sig, _ in rows))
+        conn.executemany("INSERT INTO " + BANDS_TABLE + " (key, date) VALUES (?,?)",\
+                         ((key, date) for date, _, keys in rows for key in keys))
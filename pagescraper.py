@@ -3,28 +3,40 @@
 
 from lxml import html
 from html.parser import HTMLParser
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qsl, urlencode
 import collections
-import requests
 import string
 import copy
 import re
+import time
+import hashlib
+import contextlib
 import logging
 import sys
 
 import juntdb as db
 import scorer
+import httpcache
+import instrument
 
-    
-# nltk deprecation warnings won't shut up
-import imp
-import warnings
-def warn(*args, **kwargs):
-    pass
-warnings.warn = warn
-from nltk import pos_tag, word_tokenize
-from nltk.tokenize import RegexpTokenizer
-imp.reload(warnings)
+# Query parameters that only track the visitor. Removed from the url_key of a posting
+TRACKING_PARAMS = set(['sjdu', 'tk', 'from', 'advn', 'vjs', 'fccid', 'rh', 'adid', 'xkcb', 'idpartenaire', 'ref', 'src', 'source'])
+
+# Query parameters that identify the posting on their own, per domain
+IDENTITY_PARAMS = {'indeed': ['jk']}
+
+# Processed tokens of the bodystrings already seen, see TokenCache. Bump TOKENIZER_VERSION whenever preprocess_bodystring changes its output
+TOKEN_CACHE_TABLE = 'token_cache'
+TOKEN_CACHE_SIZE = 200000
+TOKENIZER_VERSION = 2
+
+# If true, preprocess_bodystring tokenizes with tokenize_fast instead of the html parser and nltk's word_tokenize
+FAST_TOKENIZER = False
+
+# Precompiled patterns of tokenize_fast. Once the ascii punctuation is removed, word_tokenize only splits the unicode quotes and dashes, and a few contractions
+PUNCTUATION_REGEX = re.compile('[%s]' % re.escape(string.punctuation))
+QUOTES_REGEX = re.compile('([«“‘„»”’\u2012-\u2015])')
+CONTRACTIONS_REGEX = re.compile(r'\b(can)(not)\b|\b(gim|lem)(me)\b|\b(gon)(na)\b|\b(got)(ta)\b|\b(wan)(na)(?=\s)')
 
 #-------------------
 class PageScraper:
@@ -67,12 +79,20 @@ class PageScraper:
         """Returns the current date"""
         self.date_scrape = db.build_timestamp_id()
 
+    @instrument.timed('scrape')
     def scrape(self):
         """Wrapper function, scraping all information off the job posting"""
         self.get_scrape_date()
         self.build_bodystring()
         self.scraped = True
 
+    def restore(self, bodystring):
+        """Same as scrape(), but with a bodystring extracted on a previous run. The tree is not needed
+        bodystring: string previously built by build_bodystring"""
+        self.get_scrape_date()
+        self.bodystring = bodystring
+        self.scraped = True
+
 class PSsmartrecruiters(PageScraper):
     """Page scraper specific to the SmartRecruiters website"""
     def process_tree(self):
@@ -115,6 +135,7 @@ class Jentry:
                 raise Exception('Input PageScraper has not been scraped yet')
             self.date = obj.date_scrape
             self.url = obj.url
+            self.url_key = normalize_url(obj.url)
             self.bodystring = obj.bodystring
             self.loc = loc
         elif isinstance(obj, dict):
@@ -130,32 +151,18 @@ class Jentry:
 
     def preprocess_bodystring(self):
         """Processes the job posting string to recover the relevant information in it"""
-        # Remove html tags
-        text = strip_html_tags(self.bodystring)
-
-        # Change commas for space
-        regex = re.compile(',')
-        text = regex.sub('', text)
-
-        # Remove all other punctuation
-        regex = re.compile('[%s]' % re.escape(string.punctuation))
-        text = regex.sub('', text)
-
-        # only accept words that beegin with an alphabet or a number. outputs lowercase tokens
-        tokenizer = RegexpTokenizer('[A-Za-z1-9]\w+')
-        tokens = word_tokenize(text.lower())
-        
-        self.processed_tokens = scorer.stem_and_discard(tokens)
+        self.processed_tokens = preprocess_bodystring(self.bodystring)
 
     def compute_score(self):
         """Scores the job entry as defined in scorefile.csv"""
         self.preprocess_bodystring()
         self.score, self.score_hits = scorer.score(self.processed_tokens)
+        self.scorefile_version = scorer.SCOREFILE_VERSION
 
     def write_db(self, conn=False):
         """Stores the Jentry in the database. Creates a new db entry if necessary
         conn: db connection to use. If False, a new sqlite connection is created"""
-        existing_date = db.fetch_matching({'date':[self.date]})
+        existing_date = db.fetch_matching({'date':[self.date]}, conn=conn)
         new_data = False
         if not existing_date:
             new_data = True
@@ -168,27 +175,310 @@ def strip_html_tags(html):
     returns: input string without the html tags"""
     s = MLStripper()
     s.feed(html)
+    # The parser holds back the text after a trailing '&' or '<' until it is closed
+    s.close()
     return s.get_data()
 
-def scrape_job_posting(url, **kwargs):
+def normalize_url(url):
+    """Builds the deduplication key of a job posting url. The scheme, 'www.', the fragment and the tracking query parameters are discarded
+    url: string of the url
+
+    returns: string of the normalized url"""
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    params = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)\
+              if k not in TRACKING_PARAMS and not k.startswith('utm_')]
+
+    # Some websites serve the same posting on many paths, but always with the same id parameter
+    for site, id_params in IDENTITY_PARAMS.items():
+        if host.split('.')[0] == site:
+            ids = [(k, v) for k, v in params if k in id_params]
+            if ids:
+                return host + '/viewjob?' + urlencode(sorted(ids))
+
+    key = host + parsed.path.rstrip('/')
+    if params:
+        key += '?' + urlencode(sorted(params))
+    return key
+
+def init_url_index(conn):
+    """Adds the url_key column and its unique index to the db, if they are missing. Existing rows are keyed first; only the oldest of each group of duplicate urls gets a key
+    conn: sqlite connection object to use"""
+    if db.has_index('url_key', conn=conn):
+        return
+    if 'url_key' not in db.get_cols(conn=conn):
+        db.add_cols(['url_key'], ['TEXT'], conn=conn)
+
+    # Keys written by an older run may be duplicates
+    with conn:
+        conn.execute("UPDATE " + db.DEF_TABLE + " SET url_key=NULL")
+    keyed = {}
+    for date, url in conn.execute("SELECT date, url FROM " + db.DEF_TABLE + " WHERE url IS NOT NULL ORDER BY date"):
+        keyed.setdefault(normalize_url(url), date)
+    db.update_many(((date, key) for key, date in keyed.items()), ['url_key'], conn=conn)
+    db.create_index('url_key', unique=True, conn=conn)
+
+@instrument.timed('tokenize')
+def preprocess_bodystring(bodystring, fast=None):
+    """Processes a job posting string to recover the relevant information in it
+    bodystring: string of the job posting
+    fast:       if true, the string is tokenized by tokenize_fast. If None, module.FAST_TOKENIZER decides. Default is None
+
+    returns: string of the stemmed tokens"""
+    if fast is None:
+        fast = FAST_TOKENIZER
+    if fast:
+        return scorer.stem_and_discard(tokenize_fast(bodystring))
+
+    # Remove html tags
+    text = strip_html_tags(bodystring)
+
+    # Remove all punctuation, commas included
+    text = PUNCTUATION_REGEX.sub('', text)
+
+    # outputs lowercase tokens
+    nltk = scorer.nltk_import()
+    tokens = nltk['word_tokenize'](text.lower())
+    
+    return scorer.stem_and_discard(tokens)
+
+def tokenize_fast(text):
+    """Single pass replacement of the html stripping, punctuation removal and word_tokenize of preprocess_bodystring. The text is not parsed as html again: bodystrings are already made of the lxml text nodes
+    text: string of the job posting
+
+    returns: list of lowercase tokens"""
+    text = PUNCTUATION_REGEX.sub('', text.lower())
+    text = QUOTES_REGEX.sub(r' \1 ', text)
+    text = CONTRACTIONS_REGEX.sub(split_contraction, text + ' ')
+    return text.split()
+
+def split_contraction(match):
+    return ' ' + ' '.join(group for group in match.groups() if group) + ' '
+
+def bodystring_hash(bodystring):
+    """Fast content hash of a job posting string, used as the TokenCache key
+    bodystring: string of the job posting
+
+    returns: hex string of the hash"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update((str(TOKENIZER_VERSION) + ('fast' if FAST_TOKENIZER else '')).encode('ascii'))
+    h.update((bodystring or '').encode('utf-8', 'surrogatepass'))
+    return h.hexdigest()
+
+class TokenCache:
+    """Table of the processed tokens of already seen job posting strings, keyed by bodystring_hash. The least recently used entries are evicted past maxsize"""
+    def __init__(self, conn, writer=None, maxsize=TOKEN_CACHE_SIZE):
+        """Opens the cache, creating its table if necessary
+        conn:    sqlite connection object used for reading, and for writing if writer is None
+        writer:  juntdb.Writer to submit the writes to. Default is None
+        maxsize: maximum number of cached entries. Default is module.TOKEN_CACHE_SIZE"""
+        self.conn = conn
+        self.writer = writer
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.touched = []
+        self.submitted = []
+        self.pending = {}       # hash -> processed tokens, stored but maybe not committed yet
+        self.processing = set() # hashes missed by lookup, until their tokens are stored
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS " + TOKEN_CACHE_TABLE + \
+                         " (hash TEXT PRIMARY KEY, processed_tokens TEXT, last_used REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS " + TOKEN_CACHE_TABLE + "_last_used_idx ON " + \
+                         TOKEN_CACHE_TABLE + " (last_used)")
+        self.size = conn.execute("SELECT COUNT(*) FROM " + TOKEN_CACHE_TABLE).fetchone()[0]
+
+    def lookup(self, hashes):
+        """Fetches the cached processed tokens. The first occurence of every other hash is a miss, that the caller must process and store
+        hashes: list of bodystring_hash outputs
+
+        returns: dict of the cached hashes to their processed tokens. The hashes missed by a previous call map to None; their tokens are available from get once stored"""
+        self.collect()
+        missed_before = set(self.processing)
+        found = {h:self.pending[h] for h in hashes if h in self.pending}
+        unique = list(set(hashes) - set(found) - self.processing)
+        for k in range(0, len(unique), 500):
+            chunk = unique[k:k+500]
+            string = "SELECT hash, processed_tokens FROM " + TOKEN_CACHE_TABLE + \
+                     " WHERE hash IN (" + ','.join('?'*len(chunk)) + ")"
+            rows = self.conn.execute(string, chunk).fetchall()
+            found.update(rows)
+            self.touched += [h for h, _ in rows]
+
+        for h in hashes:
+            if h in missed_before:
+                found[h] = None
+            if h in found or h in self.processing:
+                # Repeats within hashes are left to the caller
+                self.hits += 1
+            else:
+                self.processing.add(h)
+                self.misses += 1
+        return found
+
+    def get(self, h):
+        """Returns the processed tokens of a stored hash, or None if it is not cached"""
+        if h in self.pending:
+            return self.pending[h]
+        string = "SELECT processed_tokens FROM " + TOKEN_CACHE_TABLE + " WHERE hash=?"
+        row = self.conn.execute(string, (h,)).fetchone()
+        return row[0] if row else None
+
+    def store(self, items):
+        """Caches newly processed tokens, and evicts the least recently used entries if the cache is full
+        items: list of (hash, processed tokens)"""
+        now = time.time()
+        if items:
+            for h, tokens in items:
+                self.pending[h] = tokens
+                self.processing.discard(h)
+            self.write(token_cache_insert, [(h, tokens, now) for h, tokens in items], [h for h, _ in items])
+        if self.touched:
+            self.write(token_cache_touch, [(now, h) for h in self.touched])
+            self.touched = []
+        if self.size > self.maxsize:
+            self.write(token_cache_evict, [self.size - self.maxsize])
+            self.size = self.maxsize
+
+    def write(self, fct, rows, inserted=None):
+        """Writes the rows with fct, directly or through the writer
+        inserted: hashes inserted by fct, i.e. token_cache_insert. They leave self.pending once committed. Default is None"""
+        if self.writer is None:
+            self.committed(fct(rows, conn=self.conn), inserted)
+        else:
+            self.submitted.append((self.writer.submit(fct, rows), inserted))
+
+    def committed(self, output, inserted):
+        if inserted is not None:
+            self.size += output
+            for h in inserted:
+                self.pending.pop(h, None)
+
+    def collect(self, wait=False):
+        """Accounts for the writes committed by the writer
+        wait: if true, waits for all the submitted writes. Default is False"""
+        remaining = []
+        for future, inserted in self.submitted:
+            if wait or future.done():
+                self.committed(future.result(), inserted)
+            else:
+                remaining.append((future, inserted))
+        self.submitted = remaining
+
+    def flush(self):
+        """Writes the pending updates and waits for the writer to commit them"""
+        self.store([])
+        self.collect(wait=True)
+        # The size is only known once the inserts are committed
+        if self.size > self.maxsize:
+            self.store([])
+            self.collect(wait=True)
+
+    def stats(self):
+        """Returns a dict of the cache size, hits, misses and hit rate"""
+        calls = self.hits + self.misses
+        hit_rate = self.hits / calls if calls else 0.0
+        return {'size':self.size, 'hits':self.hits, 'misses':self.misses, 'hit_rate':hit_rate}
+
+def token_cache_insert(rows, conn, commit=True):
+    """Inserts (hash, processed tokens, last used time) rows in the token cache table. Hashes already cached are skipped
+
+    returns: number of rows inserted"""
+    before = conn.total_changes
+    with (conn if commit else contextlib.nullcontext()):
+        conn.executemany("INSERT OR IGNORE INTO " + TOKEN_CACHE_TABLE + " VALUES (?,?,?)", rows)
+    return conn.total_changes - before
+
+def token_cache_touch(rows, conn, commit=True):
+    """Updates the last used time of (last used time, hash) rows of the token cache table"""
+    with (conn if commit else contextlib.nullcontext()):
+        conn.executemany("UPDATE " + TOKEN_CACHE_TABLE + " SET last_used=? WHERE hash=?", rows)
+
+def token_cache_evict(rows, conn, commit=True):
+    """Deletes the rows[0] least recently used entries of the token cache table"""
+    string = "DELETE FROM " + TOKEN_CACHE_TABLE + " WHERE hash IN (SELECT hash FROM " + TOKEN_CACHE_TABLE + \
+             " ORDER BY last_used LIMIT ?)"
+    with (conn if commit else contextlib.nullcontext()):
+        conn.execute(string, (rows[0],))
+
+def score_bodystring(bodystring):
+    """Scores a job posting string as defined in scorefile.csv, without going through a Jentry
+    bodystring: string of the job posting
+
+    returns: (score, score hits, processed tokens)"""
+    processed_tokens = preprocess_bodystring(bodystring)
+    score, score_hits = scorer.score(processed_tokens)
+    return score, score_hits, processed_tokens
+
+@instrument.timed('scrape_job_posting')
+def scrape_job_posting(url, use_cache=True, **kwargs):
     """Scrapes a Jentry from the job posting url. It first assigns the appropriate page scraper object, then builds a Jentry objet out of it.
-    url:    string of the url of the job posting to scrape
-    kwargs: kwargs to pass to the Jentry constructor
+    url:       string of the url of the job posting to scrape
+    use_cache: if true, a posting seen on a previous run is only downloaded and parsed again if the server reports it changed. Default is True
+    kwargs:    kwargs to pass to the Jentry constructor
     
     returns: Jentry built from the input url"""
-    r = requests.get(url, allow_redirects=True)
-    true_url = r.url
-    tree = html.fromstring(r.content)
-
-    # Use domain-appropriate scraper
+    session = httpcache.get_session()
+    if not use_cache:
+        r = fetch(session, url)
+        return jentry_from_page(r.url, r.content, **kwargs)
+
+    cache = httpcache.get_cache()
+    entry = cache.lookup(url)
+    if entry is None:
+        r = fetch(session, url)
+    else:
+        # Go straight to the url seen after redirections on the previous run
+        r = fetch(session, entry[0], headers=cache.validators(entry))
+
+    if entry is not None and r.status_code == 304:
+        cache.hit(entry)
+        true_url = entry[0]
+        scraper = get_scraper_cls(true_url)(true_url, None)
+        scraper.restore(entry[3])
+        return Jentry(scraper, **kwargs)
+
+    jentry = jentry_from_page(r.url, r.content, **kwargs)
+    cache.store(url, r, jentry.bodystring)
+    return jentry
+
+def fetch(session, url, **kwargs):
+    """Downloads the url, following redirections. The download time is recorded per domain, see instrument
+    session: requests session to use
+    url:     string of the url
+    kwargs:  kwargs to pass to session.get
+
+    returns: requests response"""
+    started = instrument.start()
+    r = session.get(url, allow_redirects=True, **kwargs)
+    instrument.stop('fetch/' + str(urlparse(url).hostname), started)
+    return r
+
+def get_scraper_cls(true_url):
+    """Returns the domain-appropriate page scraper class
+    true_url: string of the url of the page, after redirections"""
     domain = urlparse(true_url).hostname
     if domain in ['www.indeed.ca', 'www.indeed.com']:
-        scraper_cls = PSindeedCa
+        return PSindeedCa
     elif domain in ['www.smartrecruiters.ca', 'www.smartrecruiters.com']:
-        scraper_cls = PSsmartrecruiters
+        return PSsmartrecruiters
     else:
-        scraper_cls = PageScraper
-    scraper = scraper_cls(true_url, tree)
+        return PageScraper
+
+@instrument.timed('parse_page')
+def jentry_from_page(true_url, content, **kwargs):
+    """Builds a Jentry from an already downloaded job posting, using the domain-appropriate page scraper
+    true_url: string of the url of the page, after redirections
+    content:  bytes of the html page
+    kwargs:   kwargs to pass to the Jentry constructor
+
+    returns: Jentry built from the page"""
+    tree = html.fromstring(content)
+
+    # Use domain-appropriate scraper
+    scraper = get_scraper_cls(true_url)(true_url, tree)
     scraper.scrape()
     return Jentry(scraper, **kwargs)
     
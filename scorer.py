@@ -3,21 +3,17 @@
 
 import csv
 import re
+import os
+import json
+import pickle
+import hashlib
+import warnings
+import collections
+import numpy as np
 import juntdb
+import instrument
 
 
-# nltk deprecation warnings won't shut up
-import imp
-import warnings
-def warn(*args, **kwargs):
-    pass
-warnings.warn = warn
-from nltk import pos_tag, word_tokenize
-from nltk.stem.snowball import SnowballStemmer
-from nltk.tokenize import RegexpTokenizer
-from nltk.corpus import stopwords, words
-imp.reload(warnings)
-
 # The following non-english words will not be discarded
 TECHNICAL_TOKENS = ['python', 'scala', 'css', 'hadoop', 'java', 'b', 'sc', 'ph', 'd', 'r', 'objectoriented', 'zsh', 'msc', 'phd', 'meng', 'eng', 'html', 'javascript', 'jquery', 'api', 'php', 'unix', 'linuxunix', 'sql', 'mysql', 'sqlite', 'kaggle']
 TECHNICAL_TOKENS += [str(x) for x in range(100)] # Such that years of experience get included
@@ -27,22 +23,47 @@ TECHNICAL_TOKENS = set(TECHNICAL_TOKENS)
 USELESS_TOKENS = ['bold', 'color', 'margin', 'left', 'background', 'dash', 'true', 'fals', 'transpar', 'visibl', 'hidden', 'border', 'none', 'pad', 'solid', 'height', 'posit', 'display', 'member', 'width', 'follow', 'inwrap', 'label', 'function', 'absol', 'right', 'close', 'relat', 'outlin', 'job', 'ga', 'reach', 'el', 'search', 'subhead', 'center', 'return', 'locat', 'find', 'mmiddle', 'underlin'
 ]
 
-LINUX_WORDS = set(line.strip() for line in open('linuxwords')).union(TECHNICAL_TOKENS)
-ENGLISH_VOCAB = set(w.lower() for w in words.words()).union(LINUX_WORDS)
-UNWANTED_SET = stopwords.words('english') + USELESS_TOKENS
-
 # File of regex entries
 SCOREFILE = "scorefile.csv"
 
+# Precomputed LINUX_WORDS, ENGLISH_VOCAB and UNWANTED_SET. Rebuilt whenever linuxwords or the token lists above change
+LINUX_WORDS_FILE = "linuxwords"
+VOCAB_SNAPSHOT = "vocab.pickle"
+
+# The vocabularies, the stem cache and the scorefile are only loaded on first use, by load_vocab and load_scorefile
+LAZY_ATTRIBUTES = {}
+NLTK_NAMES = {}
+
+# Persistent token -> stem cache
+STEM_CACHE_FILE = "stemcache.json"
+STEM_CACHE_SIZE = 200000
+
+# Number of texts unpacked at once by RuleMatrix
+RULE_MATRIX_CHUNK = 65536
+
+# Scorefile alternatives that rule_fts_query can express as FTS5 phrases. Anything else is matched with its regex
+FTS_WORDS_REGEX = re.compile('[a-z0-9]+( [a-z0-9]+)*')
+
 
+@instrument.timed('score')
 def score(text, final_score=0):
     """Scores the input text by checking the occurence of words in module.SCOREFILE
     text:  input string to score
     score: initial for the score. Default is 0
     
     returns: score of the input text"""
+    load_scorefile()
+    return MATCHER.score(text, final_score=final_score)
+
+def score_per_row(text, final_score=0):
+    """Reference implementation of score(), running every scorefile regex over the whole text
+    text:  input string to score
+    score: initial for the score. Default is 0
+    
+    returns: score of the input text"""
+    load_scorefile()
     hit_list = []
-    for regex, regex_string, score in REGEX_LIST:
+    for regex, regex_string, score, _ in REGEX_LIST:
         matchlist = regex.findall(text)
         if matchlist:
             final_score += score
@@ -50,28 +71,140 @@ def score(text, final_score=0):
 
     return final_score, hit_list
 
+def rescore(text, score_hits, old_rules=None, final_score=0):
+    """Updates the score of a text scored with another version of the scorefile. Only the rows absent from that version are matched against the text; the others keep their previous outcome with their current score
+    text:       processed tokens previously scored
+    score_hits: hit list output by score() with the other version
+    old_rules:  set of the scorefile rows of the other version. If None, every row is matched. Default is None
+    score:      initial for the score. Default is 0
+
+    returns: same as score()"""
+    if old_rules is None:
+        return score(text, final_score=final_score)
+    load_scorefile()
+    previous_hits = set(regex_string for regex_string, _ in score_hits)
+    new_hits = {}
+    hit_list = []
+    for regex, regex_string, score, _ in REGEX_LIST:
+        if regex_string in old_rules:
+            hit = regex_string in previous_hits
+        else:
+            if regex_string not in new_hits:
+                new_hits[regex_string] = regex.search(text) is not None
+            hit = new_hits[regex_string]
+        if hit:
+            final_score += score
+            hit_list.append((regex_string, score))
+
+    return final_score, hit_list
+
 def stem_and_discard(input_tokens, delim_char=' '):
     """Discards non-english words and stems the remainder
     input_tokens: tokens to process
     delim_char:   string to put between the final tokens. Default is ' '
     
     returns: string containg the non-discarded roots of the input tokens"""
-    stemmer = SnowballStemmer("english")
+    load_vocab()
+    stem = STEM_CACHE.stem
     output_str = ''
     for token in input_tokens:
         if token not in ENGLISH_VOCAB:
             pass
-        stemmed_token = stemmer.stem(token)
+        stemmed_token = stem(token)
         if stemmed_token not in UNWANTED_SET:
             output_str += stemmed_token + delim_char
     return output_str
 
+class StemCache:
+    """Bounded token -> stem cache with least recently used eviction"""
+    def __init__(self, stemmer=None, maxsize=STEM_CACHE_SIZE):
+        """Initializes an empty cache
+        stemmer: object with a stem(token) method. If None, the nltk english SnowballStemmer is built on the first cache miss
+        maxsize: maximum number of cached tokens. Default is module.STEM_CACHE_SIZE"""
+        self.stemmer = stemmer
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.new = None # token -> stem computed since the last pop_new, once record_new was called
+
+    def stem(self, token):
+        """Returns the stem of the token, computing it only if it is not cached"""
+        try:
+            stemmed_token = self.cache[token]
+        except KeyError:
+            pass
+        else:
+            self.cache.move_to_end(token)
+            self.hits += 1
+            return stemmed_token
+
+        self.misses += 1
+        if self.stemmer is None:
+            self.stemmer = nltk_import()['SnowballStemmer']("english")
+        stemmed_token = self.stemmer.stem(token)
+        self.cache[token] = stemmed_token
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        if self.new is not None:
+            self.new[token] = stemmed_token
+        return stemmed_token
+
+    def record_new(self):
+        """Starts recording the computed stems and the counts, for pop_new. Used in the worker processes, whose cache is not saved"""
+        self.new = {}
+        self.popped = (self.hits, self.misses)
+
+    def pop_new(self):
+        """Returns what was recorded since the previous call, see record_new
+
+        returns: dict of the 'stems' list of (token, stem), and the 'hits' and 'misses' counts"""
+        new = {'stems':list(self.new.items()), 'hits':self.hits - self.popped[0], 'misses':self.misses - self.popped[1]}
+        self.new = {}
+        self.popped = (self.hits, self.misses)
+        return new
+
+    def merge(self, new):
+        """Adds the stems and counts recorded by another cache, e.g. of a worker process, such that they are saved with this one
+        new: output of pop_new of the other cache"""
+        for token, stemmed_token in new['stems']:
+            self.cache[token] = stemmed_token
+            self.cache.move_to_end(token)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        self.hits += new['hits']
+        self.misses += new['misses']
+
+    def stats(self):
+        """Returns a dict of the cache size, hits, misses and hit rate"""
+        calls = self.hits + self.misses
+        hit_rate = self.hits / calls if calls else 0.0
+        return {'size':len(self.cache), 'hits':self.hits, 'misses':self.misses, 'hit_rate':hit_rate}
+
+    def save(self, filename=STEM_CACHE_FILE):
+        """Writes the cache to disk, from least to most recently used
+        filename: string of the cache file. Default is module.STEM_CACHE_FILE"""
+        with open(filename, 'w') as f:
+            json.dump(list(self.cache.items()), f)
+
+    def load(self, filename=STEM_CACHE_FILE):
+        """Fills the cache from disk. Does nothing if the file does not exist
+        filename: string of the cache file. Default is module.STEM_CACHE_FILE"""
+        if not os.path.exists(filename):
+            return
+        with open(filename) as f:
+            for token, stemmed_token in json.load(f):
+                self.cache[token] = stemmed_token
+                self.cache.move_to_end(token)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
 def preprocess_scorefile(filename, disp=False):
     """Preprocesses the scoretext into regex entries, one for each row in the scorefile
     filename: string ote filename
     disp:     If true, displays the tokenized version of the scorefile
     
-    returns: list of compiled regex parsers"""
+    returns: list of (compiled regex, scorefile row, row score, stemmed alternatives)"""
     with open(SCOREFILE) as f:
         r = csv.reader(f)
         raw_read = [tuple(row) for row in r if row]
@@ -90,16 +223,270 @@ def preprocess_scorefile(filename, disp=False):
         tmp = '\\b' # Enclosing chars
         left = '(' + tmp
         right = tmp + ')'
-        regex_string = left + (right+'|'+left).join(tokenized.split('|')) + right
-        entry_list.append((re.compile(regex_string), x[0], float(x[1])))
+        alternatives = tokenized.split('|')
+        regex_string = left + (right+'|'+left).join(alternatives) + right
+        entry_list.append((re.compile(regex_string), x[0], float(x[1]), alternatives))
 
     return entry_list
 
+def rule_fts_query(alternatives):
+    """Builds the FTS5 query matching the same texts as a scorefile row, one phrase per alternative
+    alternatives: stemmed alternatives of the row, as output by preprocess_scorefile
+
+    returns: query string, or None if an alternative is not a plain sequence of words"""
+    phrases = []
+    for alt in alternatives:
+        if not FTS_WORDS_REGEX.fullmatch(alt):
+            return None
+        phrases.append('"' + alt + '"')
+    return ' OR '.join(phrases)
+
+class RuleMatcher:
+    """Combined matcher for all the scorefile rows. The words of the text are extracted in a single pass; only the rows that can possibly match are then confirmed"""
+    WORD_REGEX = re.compile(r'\w+')
+
+    def __init__(self, entry_list):
+        """Indexes the scorefile entries by their leading word
+        entry_list: output of preprocess_scorefile"""
+        self.entry_list = entry_list
+        self.single_words = {} # word -> rows matched by that word alone
+        self.first_words = {}  # first word of a multi word alternative -> rows to confirm with their regex
+        self.always_check = set() # rows whose alternatives cannot be indexed
+        for k, (_, _, _, alternatives) in enumerate(entry_list):
+            for alt in alternatives:
+                first = self.WORD_REGEX.match(alt)
+                if self.WORD_REGEX.fullmatch(alt):
+                    self.single_words.setdefault(alt, set()).add(k)
+                elif first:
+                    self.first_words.setdefault(first.group(), set()).add(k)
+                else:
+                    self.always_check.add(k)
+
+    def find_hits(self, text):
+        """Finds the scorefile rows that match the text
+        text: input string to match
+
+        returns: sorted list of the matching row indexes"""
+        words = set(self.WORD_REGEX.findall(text))
+        hits = set()
+        for word in words.intersection(self.single_words):
+            hits.update(self.single_words[word])
+
+        to_check = set(self.always_check)
+        for word in words.intersection(self.first_words):
+            to_check.update(self.first_words[word])
+        for k in to_check - hits:
+            if self.entry_list[k][0].search(text):
+                hits.add(k)
+
+        return sorted(hits)
+
+    def score(self, text, final_score=0):
+        """Scores the input text. Same output as score_per_row
+        text:  input string to score
+        score: initial for the score. Default is 0
+        
+        returns: (score, list of (scorefile row, row score))"""
+        hit_list = []
+        for k in self.find_hits(text):
+            _, regex_string, score, _ = self.entry_list[k]
+            final_score += score
+            hit_list.append((regex_string, score))
+
+        return final_score, hit_list
+
+class RuleMatrix:
+    """Bit-packed presence matrix of the scorefile rows in a corpus, one line per text. The scores of the whole corpus are then a single product with the row weights, such that a change of the weights does not require matching the texts again"""
+    def __init__(self, texts, hit_lists=None, matcher=None):
+        """Encodes the corpus
+        texts:     list of processed tokens strings
+        hit_lists: list of the hit lists output by score() for the same texts. A text whose hit list is not None is not matched again; only valid if the scorefile rows did not change since. Default is None
+        matcher:   RuleMatcher of the scorefile rows. If None, the matcher of module.SCOREFILE is used. Default is None"""
+        if matcher is None:
+            load_scorefile()
+            matcher = MATCHER
+        self.matcher = matcher
+        self.rules = [regex_string for _, regex_string, _, _ in matcher.entry_list]
+        rule_indexes = {}
+        for k, regex_string in enumerate(self.rules):
+            rule_indexes.setdefault(regex_string, []).append(k)
+
+        self.bits = np.zeros((len(texts), (len(self.rules) + 7)//8), dtype=np.uint8)
+        for start in range(0, len(texts), RULE_MATRIX_CHUNK):
+            chunk = texts[start:start+RULE_MATRIX_CHUNK]
+            lines, columns = [], []
+            for i, text in enumerate(chunk):
+                hit_list = hit_lists[start+i] if hit_lists is not None else None
+                if hit_list is None:
+                    hits = self.matcher.find_hits(text)
+                else:
+                    hits = [k for regex_string, _ in hit_list for k in rule_indexes[regex_string]]
+                lines += [i]*len(hits)
+                columns += hits
+            presence = np.zeros((len(chunk), len(self.rules)), dtype=bool)
+            presence[lines, columns] = True
+            self.bits[start:start+len(chunk)] = np.packbits(presence, axis=1)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def weights(self):
+        """Returns the array of the scores of the rows of the matcher"""
+        return np.array([score for _, _, score, _ in self.matcher.entry_list], dtype=np.float64)
+
+    def presence(self, start=0, stop=None):
+        """Returns the unpacked boolean presence matrix of the texts start to stop"""
+        return np.unpackbits(self.bits[start:stop], axis=1, count=len(self.rules)).astype(bool)
+
+    def scores(self, weights=None):
+        """Scores every text of the corpus. Same values as score()
+        weights: array of the score of each scorefile row. If None, the scores of the matcher are used. Default is None
+
+        returns: array of the scores"""
+        if weights is None:
+            weights = self.weights()
+        weights = np.asarray(weights, dtype=np.float64)
+
+        # The sums are computed on integers, which is exact and thus equal to the left to right float sum of score()
+        int_weights, exponent = exact_integer_weights(weights)
+        out = np.zeros(len(self), dtype=np.float64)
+        for start in range(0, len(self), RULE_MATRIX_CHUNK):
+            presence = self.presence(start, start + RULE_MATRIX_CHUNK)
+            if int_weights is not None:
+                out[start:start+len(presence)] = np.ldexp(presence.astype(np.int64) @ int_weights, exponent)
+            else:
+                for i, row in enumerate(presence):
+                    final_score = 0
+                    for k in np.flatnonzero(row):
+                        final_score += weights[k]
+                    out[start+i] = final_score
+        return out
+
+    def hit_lists(self, weights=None):
+        """Lists the scorefile rows hitting each text. Same lists as score()
+        weights: array of the score of each scorefile row. If None, the scores of the matcher are used. Default is None
+
+        returns: list of lists of (scorefile row, row score)"""
+        if weights is None:
+            weights = self.weights()
+        weights = [float(w) for w in weights]
+        hit_lists = []
+        for start in range(0, len(self), RULE_MATRIX_CHUNK):
+            for row in self.presence(start, start + RULE_MATRIX_CHUNK):
+                hit_lists.append([(self.rules[k], weights[k]) for k in np.flatnonzero(row)])
+        return hit_lists
+
+def exact_integer_weights(weights):
+    """Scales the weights to integers, such that any sum of them is computed exactly
+    weights: array of float64
+
+    returns: (int64 array, exponent) with weights == int64 array * 2**exponent, or (None, 0) if the sums could overflow the float64 mantissa"""
+    if not np.all(np.isfinite(weights)):
+        return None, 0
+    nonzero = weights[weights != 0]
+    if not len(nonzero):
+        return np.zeros(len(weights), dtype=np.int64), 0
+
+    # Exponent of the lowest set bit of every weight
+    mantissas, exponents = np.frexp(nonzero)
+    lowest = None
+    for m, e in zip(mantissas, exponents):
+        integer = int(np.ldexp(m, 53))
+        low_bit = int(e) - 53 + (integer & -integer).bit_length() - 1
+        lowest = low_bit if lowest is None else min(lowest, low_bit)
+
+    int_weights = [int(np.ldexp(w, -lowest)) for w in weights]
+    if sum(abs(w) for w in int_weights) >= 2**53:
+        return None, 0
+    return np.array(int_weights, dtype=np.int64), lowest
+
 
 
     
-# Load the scorefile once per module import. Converts it into a list of regex to be used later
-REGEX_LIST = preprocess_scorefile(SCOREFILE)
+def nltk_import():
+    """Imports the nltk tools, which are slow to load. Only the first call does anything
+
+    returns: dict of the nltk objects used by junthelper"""
+    if not NLTK_NAMES:
+        # nltk deprecation warnings won't shut up
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            from nltk import word_tokenize
+            from nltk.stem.snowball import SnowballStemmer
+            from nltk.tokenize import RegexpTokenizer
+            from nltk.corpus import stopwords, words
+        NLTK_NAMES.update(word_tokenize=word_tokenize, SnowballStemmer=SnowballStemmer,\
+                          RegexpTokenizer=RegexpTokenizer, stopwords=stopwords, words=words)
+    return NLTK_NAMES
+
+def vocab_snapshot_key():
+    """Returns what the vocabularies are built from, such that an outdated snapshot can be detected"""
+    stat = os.stat(LINUX_WORDS_FILE)
+    return [sorted(TECHNICAL_TOKENS), USELESS_TOKENS, stat.st_size, stat.st_mtime]
+
+def build_vocab():
+    """Builds the vocabularies from linuxwords and the nltk corpora. Slow
+
+    returns: (LINUX_WORDS, ENGLISH_VOCAB, UNWANTED_SET)"""
+    nltk = nltk_import()
+    with open(LINUX_WORDS_FILE) as f:
+        linux_words = set(line.strip() for line in f).union(TECHNICAL_TOKENS)
+    english_vocab = set(w.lower() for w in nltk['words'].words()).union(linux_words)
+    unwanted_set = set(nltk['stopwords'].words('english') + USELESS_TOKENS)
+    return linux_words, english_vocab, unwanted_set
+
+def load_vocab(use_snapshot=True):
+    """Loads the vocabularies and the stem cache of the previous run. Only the first call does anything
+    use_snapshot: if true, reads the vocabularies from module.VOCAB_SNAPSHOT when it is up to date, and rewrites it otherwise. Default is True"""
+    global LINUX_WORDS, ENGLISH_VOCAB, UNWANTED_SET, STEM_CACHE
+    if 'STEM_CACHE' in globals():
+        return
+
+    vocab = None
+    key = vocab_snapshot_key()
+    if use_snapshot and os.path.exists(VOCAB_SNAPSHOT):
+        with open(VOCAB_SNAPSHOT, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot['key'] == key:
+            vocab = snapshot['vocab']
+    if vocab is None:
+        vocab = build_vocab()
+        if use_snapshot:
+            with open(VOCAB_SNAPSHOT, 'wb') as f:
+                pickle.dump({'key':key, 'vocab':vocab}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    LINUX_WORDS, ENGLISH_VOCAB, UNWANTED_SET = vocab
+
+    # Single stemmer shared by the scorefile and the job postings
+    STEM_CACHE = StemCache()
+    STEM_CACHE.load()
+
+def load_scorefile():
+    """Converts the scorefile into a list of regex and the matcher used by score(). Only the first call does anything"""
+    global REGEX_LIST, MATCHER, RULES, SCOREFILE_VERSION
+    if 'MATCHER' in globals():
+        return
+    REGEX_LIST = preprocess_scorefile(SCOREFILE)
+    MATCHER = RuleMatcher(REGEX_LIST)
+
+    # The version identifies the rows and their scores, such that postings scored with another version can be updated by rescore()
+    RULES = [regex_string for _, regex_string, _, _ in REGEX_LIST]
+    weighted = [(regex_string, score) for _, regex_string, score, _ in REGEX_LIST]
+    SCOREFILE_VERSION = hashlib.sha1(repr(weighted).encode('utf-8')).hexdigest()
+
+def load():
+    """Loads everything needed for scoring. Used to warm up worker processes"""
+    load_vocab()
+    load_scorefile()
+
+def __getattr__(name):
+    """Loads the lazy module attributes on first access"""
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+    LAZY_ATTRIBUTES[name]()
+    return globals()[name]
+
+LAZY_ATTRIBUTES.update(dict.fromkeys(['LINUX_WORDS', 'ENGLISH_VOCAB', 'UNWANTED_SET', 'STEM_CACHE'], load_vocab))
+LAZY_ATTRIBUTES.update(dict.fromkeys(['REGEX_LIST', 'MATCHER', 'RULES', 'SCOREFILE_VERSION'], load_scorefile))
 
 
 
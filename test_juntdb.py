@@ -0,0 +1,33 @@
+"""Tests of juntdb"""
+
+import os
+
+import pytest
+
+import juntdb
+
+
+def build_rows(n_rows, **kwargs):
+    start = int(juntdb.build_timestamp_id())
+    return [dict({'date':start + k, 'url':'http://www.example.com/job/' + str(k)}, **kwargs) for k in range(n_rows)]
+
+def test_writer_group_rolls_back_new_columns(tmp_path):
+    dbase_file = os.path.join(str(tmp_path), 'test.sqlite')
+    juntdb.init(dbase_file=dbase_file)
+    conn = juntdb.connect(dbase_file)
+    juntdb.add_cols(['url_key'], ['TEXT'], conn=conn)
+    juntdb.create_index('url_key', unique=True, conn=conn)
+
+    # Queued before the writer starts, such that both batches are in the same group
+    writer = juntdb.Writer(dbase_file)
+    good = writer.add_many(build_rows(3))
+    bad = writer.add_many([dict(row, url_key='same', extra='new column') for row in build_rows(2)])
+    writer.start()
+    writer.close()
+
+    assert good.result() == 3
+    with pytest.raises(Exception):
+        bad.result()
+    rows = conn.execute('SELECT COUNT(*), COUNT(DISTINCT url) FROM ' + juntdb.DEF_TABLE).fetchone()
+    assert tuple(rows) == (3, 3)
+    assert 'extra' not in juntdb.get_cols(conn=conn)
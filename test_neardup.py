@@ -0,0 +1,20 @@
+"""Tests of neardup"""
+
+import os
+
+import juntdb
+import neardup
+
+
+def test_short_bodies_are_not_duplicates(tmp_path):
+    dbase_file = os.path.join(str(tmp_path), 'test.sqlite')
+    juntdb.init(dbase_file=dbase_file)
+    conn = juntdb.connect(dbase_file)
+    index = neardup.NearDupIndex(conn=conn)
+    body = ' '.join('word' + str(k) for k in range(50))
+    entries = [(20260101000000000, ''), (20260101000000001, '  \n '), (20260101000000002, 'four words only here'),\
+               (20260101000000003, body), (20260101000000004, body)]
+    conn.executemany('INSERT INTO ' + juntdb.DEF_TABLE + ' (date, bodystring) VALUES (?,?)', entries)
+
+    assert neardup.signature('') is None
+    assert index.flag(entries) == [(20260101000000004, 20260101000000003)]
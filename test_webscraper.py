@@ -0,0 +1,64 @@
+"""Tests of webscraper. The crawls run in a fresh interpreter, since the twisted reactor cannot be restarted"""
+
+import os
+import types
+import tempfile
+import multiprocessing
+import concurrent.futures
+
+import juntdb
+import mockboard
+import webscraper
+
+
+def test_throttle_takes_strictest_settings():
+    webscraper.THROTTLES = {}
+    indeed = dict(webscraper.throttle_config(webscraper.Settings(webscraper.PIPELINE_SETTINGS)),
+                  **webscraper.SpiderIndeedCa.custom_settings)
+    careerjet = dict(indeed, **webscraper.SpiderCareerjetCa.custom_settings)
+    throttle = webscraper.get_throttle('example.com', careerjet)
+    assert webscraper.get_throttle('example.com', indeed) is throttle
+    assert throttle.concurrency == 2
+    assert throttle.delay == 1.0
+
+    # The delay adapted since is not raised again by the next requests
+    throttle.delay = 0.1
+    webscraper.get_throttle('example.com', indeed)
+    webscraper.get_throttle('example.com', careerjet)
+    assert throttle.delay == 0.1
+
+def test_pipeline_survives_failed_batch():
+    pipeline = webscraper.JuntdbPipeline(batch_size=10, flush_interval=60)
+    pipeline.spider = types.SimpleNamespace(dupp_count=0, near_dupp_count=0, failed_rows=0)
+    failed = concurrent.futures.Future()
+    failed.set_exception(ValueError('bad batch'))
+    written = concurrent.futures.Future()
+    written.set_result(1)
+    pipeline.submitted = [([{'url':'a'}, {'url':'b'}], failed), ([{'url':'c'}, {'url':'d'}], written)]
+
+    pipeline.collect()
+    pipeline.collect(wait=True)
+    assert pipeline.submitted == []
+    assert pipeline.spider.failed_rows == 2
+    assert pipeline.spider.dupp_count == 1
+
+def crawl_shared_host(base_url, dbase_dir):
+    """Crawls the mock board with an Indeed and a Careerjet spider, with their own THROTTLE_* settings
+
+    returns: number of rows written"""
+    os.chdir(dbase_dir)
+    juntdb.init()
+    indeed = type('MockIndeed', (webscraper.SpiderIndeedCa,), {'main_url_prefix':base_url})
+    careerjet = type('MockCareerjet', (webscraper.SpiderCareerjetCa,), {'main_url_prefix':base_url})
+    webscraper.crawl_many([(indeed, ['search'], {'views_per_page':5}), (careerjet, ['search'], {})], {'LOG_LEVEL':'WARNING'})
+    return juntdb.get_conn().execute('SELECT COUNT(*) FROM ' + juntdb.DEF_TABLE).fetchone()[0]
+
+def test_crawl_spider_classes_sharing_host():
+    board = mockboard.MockBoard(port=0, result_pages=2, per_page=5)
+    board.start()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir, concurrent.futures.ProcessPoolExecutor(1, multiprocessing.get_context('spawn')) as pool:
+            count = pool.submit(crawl_shared_host, board.base_url, tmpdir).result()
+    finally:
+        board.stop()
+    assert count == 20
@@ -5,17 +5,140 @@ import scrapy
 import logging
 import sys
 import traceback
-from twisted.internet import reactor
+import time
+import collections
+import email.utils
+import threading
+from scrapy.utils.reactor import install_reactor
+
+# scrapy refuses to crawl with another reactor than TWISTED_REACTOR, and importing twisted.internet.reactor installs the default one. Install it first, unless the caller already did
+TWISTED_REACTOR = 'twisted.internet.asyncioreactor.AsyncioSelectorReactor'
+if 'twisted.internet.reactor' not in sys.modules:
+    install_reactor(TWISTED_REACTOR)
+
+from twisted.internet import reactor, task, threads
 from scrapy.utils.log import configure_logging
 from scrapy.crawler import CrawlerRunner, CrawlerProcess
 from scrapy.settings import Settings
+from scrapy.exceptions import NotConfigured
+from scrapy.core.scheduler import Scheduler
 from pydispatch import dispatcher
 from datetime import datetime
+from urllib.parse import urlparse
 
 import juntdb
-from pagescraper import scrape_job_posting
-
-
+import neardup
+import instrument
+from pagescraper import jentry_from_page, normalize_url, init_url_index
+
+
+# Scraped postings are written to juntdb by JuntdbPipeline, by batches of JUNTDB_BATCH_SIZE or every JUNTDB_FLUSH_INTERVAL seconds
+# Postings more similar than JUNTDB_NEARDUP_THRESHOLD to a stored one are flagged as its duplicate, and never scored. 0 disables the detection
+# InstrumentExtension records the download latency per domain, and copies the stages of its own crawl in the stats of the crawl. It is only active if instrument is enabled
+PIPELINE_SETTINGS = {
+    'TWISTED_REACTOR': TWISTED_REACTOR,
+    'ITEM_PIPELINES': {'webscraper.JuntdbPipeline': 300},
+    'EXTENSIONS': {'webscraper.InstrumentExtension': 500},
+    'JUNTDB_BATCH_SIZE': 100,
+    'JUNTDB_FLUSH_INTERVAL': 60.0,
+    'JUNTDB_NEARDUP_THRESHOLD': neardup.DEF_THRESHOLD,
+    'SCHEDULER': 'webscraper.ThrottleScheduler',
+    'DOWNLOADER_MIDDLEWARES': {'webscraper.ThrottleMiddleware': 950},
+    'RETRY_HTTP_CODES': [500, 502, 503, 504, 522, 524, 408, 429],
+    'RETRY_TIMES': 5,
+}
+
+# ThrottleScheduler paces the requests to each domain across all the spiders of a crawl, and ThrottleMiddleware feeds it the responses. Spider classes override these in their custom_settings, the same for all the spiders of a domain
+# The delay between two requests to a domain tends to the download latency divided by THROTTLE_TARGET_CONCURRENCY, within [THROTTLE_MIN_DELAY, THROTTLE_MAX_DELAY]
+# A 429 or 503 response doubles the delay, to at least THROTTLE_BACKOFF_DELAY, and pauses the domain for the Retry-After of the response, up to THROTTLE_MAX_RETRY_AFTER
+# The requests per second of every THROTTLE_RATE_WINDOW seconds are reported in the crawl stats
+PIPELINE_SETTINGS.update({
+    'THROTTLE_ENABLED': True,
+    'THROTTLE_DOMAIN_CONCURRENCY': 8,
+    'THROTTLE_START_DELAY': 0.25,
+    'THROTTLE_MIN_DELAY': 0.0,
+    'THROTTLE_MAX_DELAY': 60.0,
+    'THROTTLE_TARGET_CONCURRENCY': 4.0,
+    'THROTTLE_BACKOFF_DELAY': 1.0,
+    'THROTTLE_MAX_RETRY_AFTER': 300.0,
+    'THROTTLE_RATE_WINDOW': 10.0,
+})
+THROTTLE_KEYS = [x for x in PIPELINE_SETTINGS if x.startswith('THROTTLE_') and x != 'THROTTLE_ENABLED']
+# When spider classes with different settings request the same domain, its throttle takes the strictest value of each setting
+THROTTLE_STRICTEST = {
+    'THROTTLE_DOMAIN_CONCURRENCY': min,
+    'THROTTLE_START_DELAY': max,
+    'THROTTLE_MIN_DELAY': max,
+    'THROTTLE_MAX_DELAY': max,
+    'THROTTLE_TARGET_CONCURRENCY': min,
+    'THROTTLE_BACKOFF_DELAY': max,
+    'THROTTLE_MAX_RETRY_AFTER': max,
+    'THROTTLE_RATE_WINDOW': max,
+}
+
+class UrlFrontier:
+    """Normalized posting urls claimed during a crawl, shared by all the spiders of the process. A spider only requests the postings it claimed first, such that every posting is downloaded and parsed once whatever the number of overlapping searches"""
+    def __init__(self):
+        self.owners = {} # url key -> spider that claimed it
+        self.skipped = {} # url key -> [(spider, (posting url, job location))] of the other spiders that found it claimed
+        self.lock = threading.Lock()
+
+    def claim(self, key, spider):
+        """Claims the posting for the spider, unless it is already claimed
+        key:    string of the normalized url of the posting, see pagescraper.normalize_url
+        spider: spider about to request the posting
+
+        returns: true if the spider claimed the posting, false if it was claimed before, see owner"""
+        with self.lock:
+            if key in self.owners:
+                return False
+            self.owners[key] = spider
+        return True
+
+    def owner(self, key):
+        """Returns the spider that claimed the posting, or None"""
+        return self.owners.get(key)
+
+    def skip(self, key, spider, posting):
+        """Records that the spider left a claimed posting to its owner. The spider takes it over if the owner fails to download it, see release
+        posting: (posting url, job location)"""
+        with self.lock:
+            self.skipped.setdefault(key, []).append((spider, posting))
+
+    def release(self, key, spider):
+        """Gives up the claim of a posting that the spider could not download. It passes to the first other spider that skipped it, if any, else any spider finding it later claims it
+
+        returns: (new owner, (posting url, job location)), or None"""
+        with self.lock:
+            if self.owners.get(key) is not spider:
+                return None
+            waiting = [x for x in self.skipped.pop(key, []) if x[0] is not spider]
+            if not waiting:
+                del self.owners[key]
+                return None
+            self.owners[key] = waiting[0][0]
+            if waiting[1:]:
+                self.skipped[key] = waiting[1:]
+            return waiting[0]
+
+    def close(self, spider):
+        """Forgets the spider as a taker of the skipped postings, once it is closed"""
+        with self.lock:
+            for key in list(self.skipped):
+                left = [x for x in self.skipped[key] if x[0] is not spider]
+                if left:
+                    self.skipped[key] = left
+                else:
+                    del self.skipped[key]
+
+    def __len__(self):
+        return len(self.owners)
+
+# Replaced at the start of every crawl_one and crawl_many run. Spiders pick the current one when they are built
+FRONTIER = UrlFrontier()
+
+# Number of consecutive postings of the previous first page that end the pagination of an incremental crawl. A lone recurring posting, e.g. sponsored or pinned, does not
+WATERMARK_RUN = 3
 
 class SpiderIndeedCa(scrapy.Spider):
     """Spider for Indeed.ca. Also used as the base class for website scrapers"""
@@ -24,14 +147,17 @@ class SpiderIndeedCa(scrapy.Spider):
     get_request = ['as_and=', '&as_phr=', '&as_any=', '&as_not=', '&as_ttl=', '&as_cmp=', '&jt=all', '&st=', '&salary=', '&radius=50',  '&l=','&fromage=', '&limit=', '&sort=date', '&psf=advsrch' 
             ]
     pagination_finish_text = 'Next\xa0»'
+    # Indeed answers 429 quickly to bursts
+    custom_settings = {'THROTTLE_DOMAIN_CONCURRENCY': 2, 'THROTTLE_START_DELAY': 1.0}
 
-    def __init__(self, match_all, match_any='', location='Montréal%2C+QC', views_per_page=20 ,max_age=15):
+    def __init__(self, match_all, match_any='', location='Montréal%2C+QC', views_per_page=20 ,max_age=15, incremental=True):
         """Initializes the website spider
         match_all:      search for all these words in a single page
         match_any:      search for any of these words in a single page. Default is ''
         location:       string containing the desired location of the search. Default is 'Montréal%2C+QC'
         viwes_per_page: int total number of job postings per result page. Default is 20
-        max_age:        int, maximum age in days of the job posting. Default is 15"""
+        max_age:        int, maximum age in days of the job posting. Default is 15
+        incremental:    if true, the pagination stops at the postings known from the previous crawls. Default is True"""
         query = self.main_url_prefix + self.search_url_prefix + self.get_request[0] + match_all.replace(' ', '+')
         query += self.get_request[1] + match_any.replace(' ', '+')
         query += ''.join(self.get_request[2:10])
@@ -43,31 +169,146 @@ class SpiderIndeedCa(scrapy.Spider):
         self.name = 'IndeedCa' + location
         self.start_urls = [query]
         self.search_page_index = 0
-        self.jentries = []
+        self.init_dedup()
+        self.init_watermark(match_all + '|' + match_any, location, incremental)
         dispatcher.connect(self.quit, scrapy.signals.spider_closed)
         logging.log(21, 'Scraping ' + self.name)
 
+    def init_dedup(self):
+        """Prepares the url deduplication. Postings are keyed by their normalized url, see pagescraper.normalize_url"""
+        self.frontier = FRONTIER
+        self.claimed_count = 0
+        self.dupp_count = 0
+        self.near_dupp_count = 0
+        self.frontier_dupp_count = 0
+        self.failed_rows = 0
+        init_url_index(juntdb.get_conn())
+
+    def filter_known(self, postings):
+        """Discards the postings already in the db, or already claimed in the frontier by this or another spider of the crawl. The db is queried once for the whole list
+        postings: list of (posting url, job location)
+
+        returns: (list of the new (posting url, job location), true if all the postings were in the db or claimed by this spider)"""
+        keys = [normalize_url(url) for url, _ in postings]
+        in_db = juntdb.fetch_existing('url_key', set(keys))
+
+        new_postings = []
+        all_known = True
+        for key, posting in zip(keys, postings):
+            if key in in_db:
+                self.dupp_count += 1
+                continue
+            if self.frontier.claim(key, self):
+                self.claimed_count += 1
+                new_postings.append(posting)
+                all_known = False
+            elif self.frontier.owner(key) is self:
+                self.dupp_count += 1
+            else:
+                # Claimed by another search; the next result pages may still hold postings of this one only
+                self.frontier.skip(key, self, posting)
+                self.frontier_dupp_count += 1
+                all_known = False
+        return new_postings, all_known
+
+    def init_watermark(self, query, location, incremental):
+        """Loads the watermark of the previous crawl of the same search, see juntdb.get_watermark
+        query:       string identifying the searched words
+        location:    string of the searched location
+        incremental: if false, the watermark is ignored, but still updated at the end of the crawl"""
+        juntdb.init_watermarks()
+        self.watermark_id = (type(self).__name__, query, location)
+        self.watermark = juntdb.get_watermark(*self.watermark_id) if incremental else None
+        self.incremental = incremental
+        self.crawl_date = juntdb.build_timestamp_id()
+        self.first_page_keys = None
+        self.watermark_stop = False
+        self.failed_pages = 0
+
+    def reached_watermark(self, postings, all_known):
+        """Decides if the pagination can stop after this result page: every posting of the page is already known, or the page holds a run of WATERMARK_RUN consecutive postings among the newest ones of the previous crawl, or only such postings
+        postings:  list of the (posting url, job location) of the result page
+        all_known: second output of filter_known for postings
+
+        returns: true if the next result pages are already known"""
+        keys = [normalize_url(url) for url, _ in postings]
+        if self.first_page_keys is None:
+            self.first_page_keys = keys
+        if not (self.incremental and postings):
+            return False
+        run = 0
+        longest = 0
+        if self.watermark is not None:
+            for key in keys:
+                run = run + 1 if key in self.watermark[0] else 0
+                longest = max(longest, run)
+        reached = all_known or longest >= min(WATERMARK_RUN, len(keys))
+        if reached:
+            self.watermark_stop = True
+        return reached
+
     def parse(self, response):
-        """Parses all the job postings present in a result page page. Proceeds until there are no more pages or the age limit is reached
+        """Parses all the job postings present in a result page page. Proceeds until there are no more pages, the age limit or the watermark of the previous crawl is reached
         response: http response to process"""
         # Grab all the job posting urls
-        for sel in response.xpath('//h2[@class="jobtitle"]'):
-            posting_url, job_location = self.get_selection_info(sel)
-            try:
-                self.jentries.append(scrape_job_posting(posting_url, loc=job_location))
-            except Exception:
-                logging.error("Unexpected error with website:" + posting_url)
-                traceback.print_exc()
+        postings = [self.get_selection_info(sel) for sel in response.xpath('//h2[@class="jobtitle"]')]
+        new_postings, all_known = self.filter_known(postings)
+        for posting_url, job_location in new_postings:
+            yield self.posting_request(posting_url, job_location)
+        if self.reached_watermark(postings, all_known):
+            return
         # Goto next page up to the end of the pagination div
         try:
-            url, url_text = self.get_pagination_info(sel, response)
+            url, url_text = self.get_pagination_info(response)
             if url_text == self.pagination_finish_text:
                 self.search_page_index += 1
                 logging.log(21, self.name + 'Processing page ' + str(self.search_page_index+1))
-                yield scrapy.Request(url)
+                yield scrapy.Request(url, errback=self.page_error)
         except IndexError:
             pass
 
+    def page_error(self, failure):
+        """Logs a result page that could not be downloaded. The watermark is then kept, since the following pages were not walked
+        failure: twisted failure of the request"""
+        self.failed_pages += 1
+        logging.error("Unexpected error with result page:" + failure.request.url + ' ' + repr(failure.value))
+
+    def posting_request(self, posting_url, job_location):
+        """Builds the request of a job posting page. It is downloaded concurrently with the other requests of the crawl
+        posting_url:  string of the url of the job posting
+        job_location: string of the location of the job
+
+        returns: scrapy.Request handled by parse_posting"""
+        return scrapy.Request(posting_url, callback=self.parse_posting, errback=self.posting_error,\
+                              cb_kwargs={'job_location':job_location}, meta={'url_key':normalize_url(posting_url)})
+
+    def parse_posting(self, response, job_location):
+        """Scrapes the downloaded job posting into a Jentry, handed to JuntdbPipeline as a dict
+        response:     http response of the job posting, after redirections
+        job_location: string of the location of the job"""
+        try:
+            with instrument.scope(crawler_stages(self.crawler)):
+                jentry = jentry_from_page(response.url, response.body, loc=job_location)
+            yield dict(jentry)
+        except Exception:
+            logging.error("Unexpected error with website:" + response.url)
+            traceback.print_exc()
+
+    def posting_error(self, failure):
+        """Logs a job posting that could not be downloaded, or was answered with an http error once the retries were exhausted. Its claim passes to another spider that found it, which requests it in turn
+        failure: twisted failure of the request"""
+        logging.error("Unexpected error with website:" + failure.request.url + ' ' + repr(failure.value))
+        key = failure.request.meta.get('url_key')
+        if self.frontier.owner(key) is not self:
+            return
+        self.claimed_count -= 1
+        taken = self.frontier.release(key, self)
+        if taken is not None:
+            spider, (posting_url, job_location) = taken
+            spider.claimed_count += 1
+            spider.frontier_dupp_count -= 1
+            spider.crawler.engine.crawl(spider.posting_request(posting_url, job_location))
+
     def get_selection_info(self, sel):
         """Extracts the target job posting url and job location from the inputi
         sel: xml tree input
@@ -77,10 +318,9 @@ class SpiderIndeedCa(scrapy.Spider):
         job_location = sel.xpath('..//span[@itemprop="addressLocality"]/text()').extract()[0]
         return posting_url, job_location
     
-    def get_pagination_info(self, sel, response):
+    def get_pagination_info(self, response):
         """Pagination info for indeed.ca. Outputs the rightmost pagination url and its text
-        sel: xml tree input
-        response: http response containing sel
+        response: http response of the result page
         
         returns: (next page url, text of the next page link"""
         rightmost_a = response.xpath('//div[@class="pagination"]/a')[-1]
@@ -88,72 +328,92 @@ class SpiderIndeedCa(scrapy.Spider):
         url = response.urljoin(rightmost_a.xpath('@href').extract()[0])
         return url, a_text
     
-    def quit(self):
-        """Executed at the end of the crawl. Add all non-dupplicate Jentry to db"""
+    def quit(self, spider=None, reason=None):
+        """Executed at the end of the crawl, once JuntdbPipeline wrote the last postings. Stores the newest postings of the crawl as the watermark of the next one, if the crawl walked all the result pages it meant to
+        spider: spider that closed. The signal reaches every spider of the process, only the closing one proceeds. Default is None
+        reason: string of the close reason. The watermark only advances if it is 'finished'. Default is None
+
+        returns: deferred fired once the watermark is committed, which scrapy waits for, or None"""
+        if spider is not None and spider is not self:
+            return
+        self.frontier.close(self)
+        stored = None
+        # A first page without any posting keeps the previous watermark. So do lost postings, such that the next crawl finds them again
+        if self.first_page_keys and reason == 'finished' and not self.failed_pages and not self.failed_rows:
+            rows = [self.watermark_id + (self.first_page_keys, self.crawl_date)]
+            future = juntdb.get_writer().submit(juntdb.set_watermarks, rows)
+            stored = threads.deferToThread(future.result)
+        elif self.first_page_keys:
+            logging.log(21, self.name + ' keeps the watermark of the previous crawl, the crawl ended with ' + str(reason) +\
+                        ', ' + str(self.failed_pages) + ' failed result pages and ' + str(self.failed_rows) + ' postings not written')
         logging.log(21, self.name + ' finished after ' + str(self.search_page_index) + 'pages')
-
-        conn = juntdb.connect()
-        try:
-            true_urls = list(list(zip(* juntdb.fetch_last_n(99999, collist=['url'], conn=conn)))[1])
-        except IndexError:
-            logging.info('Detected empty database; assuming there are no pre-existing URLS')
-            true_urls = []
-
-        # Add to db only the non-dupplicates
-        dupp_count = 0
-        for jentry in self.jentries:
-            if jentry.url in true_urls:
-                dupp_count += 1
-                continue
-            true_urls.append(jentry.url)
-            jentry.write_db(conn)
-
-        if dupp_count:
-            logging.log(21, str(dupp_count) + ' dupplicates')
-        conn.close()
+        if self.watermark_stop:
+            logging.log(21, self.name + ' stopped at the postings of the previous crawl')
+        if self.dupp_count:
+            logging.log(21, str(self.dupp_count) + ' dupplicates')
+        if self.near_dupp_count:
+            logging.log(21, str(self.near_dupp_count) + ' near-dupplicates')
+        if self.frontier_dupp_count:
+            logging.log(21, str(self.frontier_dupp_count) + ' postings left to the other spiders')
+        self.crawler.stats.set_value('frontier/claimed', self.claimed_count)
+        self.crawler.stats.set_value('frontier/skipped', self.frontier_dupp_count)
+        self.crawler.stats.set_value('juntdb/failed_rows', self.failed_rows)
+        return stored
 
 class SpiderCareerjetCa(SpiderIndeedCa):
     """Spider for careerjet.ca"""
     main_url_prefix = 'http://www.careerjet.ca'
     search_url_prefix = '/wsearch/jobs?'
     get_request = ['s=',  '&l=', '&sort=date']
+    custom_settings = {'THROTTLE_DOMAIN_CONCURRENCY': 4, 'THROTTLE_START_DELAY': 0.5}
 
-    def __init__(self, match_all, location='Montreal%2C+QC', max_age=3):
+    def __init__(self, match_all, location='Montreal%2C+QC', max_age=3, incremental=True):
         """Initializes the website spider
         match_all:      search for all these words in a single page
         location:       string containing the desired location of the search. Default is 'Montréal%2C+QC'
         viwes_per_page: int total number of job postings per result page. Default is 20
-        max_age:        int, maximum age in days of the job posting. Default is 15"""
+        max_age:        int, maximum age in days of the job posting. Default is 15
+        incremental:    if true, the pagination stops at the postings known from the previous crawls. Default is True"""
         query = self.main_url_prefix + self.search_url_prefix + self.get_request[0] + match_all.replace(' ', '+')
         query += self.get_request[1] + location
         query += ''.join(self.get_request[2:])
         self.name = 'CareerjetCa' + location
         self.start_urls = [query]
-        self.jentries = []
         self.max_age = max_age
         self.search_page_index = 0
+        self.init_dedup()
+        self.init_watermark(match_all, location, incremental)
         dispatcher.connect(self.quit, scrapy.signals.spider_closed)
         logging.log(21, 'Scraping ' + self.name)
 
     def parse(self, response):
-        """Parses all the job postings present in a result page page. Proceeds until there are no more pages or the age limit is reached
+        """Parses all the job postings present in a result page page. Proceeds until there are no more pages, the age limit or the watermark of the previous crawl is reached
         response: http response to process"""
+        # Postings dated before the day of the previous crawl were seen by it
+        watermark_age = self.watermark_age() if self.incremental and self.watermark is not None else None
+
         # Grab all the job posting urls and calculate their age based on their post date and today's date
         reached_max_age = False
+        postings = []
         for sel in response.xpath('//div[@class="job"]'):
             # Find if job too old
             full_date = sel.xpath('p//span[@class="date_compact"]/script/text()').extract()[0][19:-3]
-            if date_age(full_date) > self.max_age:
+            age = date_age(full_date)
+            if age > self.max_age:
                 reached_max_age = True
                 break
+            if watermark_age is not None and age > watermark_age:
+                self.watermark_stop = True
+                break
             posting_url = response.urljoin(sel.xpath('h2/a/@href').extract()[0])
             job_location = sel.xpath('p//a[@class="locations_compact"]/text()').extract()[0]
-            try:
-                self.jentries.append(scrape_job_posting(posting_url, loc=job_location))
-            except Exception:
-                logging.error("Unexpected error with website:" + posting_url)
-                traceback.print_exc()
-                
+            postings.append((posting_url, job_location))
+
+        new_postings, all_known = self.filter_known(postings)
+        for posting_url, job_location in new_postings:
+            yield self.posting_request(posting_url, job_location)
+        if self.reached_watermark(postings, all_known) or self.watermark_stop:
+            return
 
         # Goto next page up to the end of the pagination div
         try:
@@ -163,29 +423,391 @@ class SpiderCareerjetCa(SpiderIndeedCa):
             if a_text == ' >>' and not reached_max_age:
                 self.search_page_index += 1
                 logging.log(21, self.name + 'Processing page ' + str(self.search_page_index+1))
-                yield scrapy.Request(url)
+                yield scrapy.Request(url, errback=self.page_error)
         except IndexError:
             pass
 
+    def watermark_age(self):
+        """Age in days of the previous crawl, see date_age"""
+        return date_age(datetime.strptime(str(self.watermark[1])[:8], '%Y%m%d').strftime('%B %d'))
+
+class JuntdbPipeline:
+    """Item pipeline writing the scraped postings to juntdb by batches, such that the memory stays bounded and the postings are stored as the crawl goes"""
+    def __init__(self, batch_size, flush_interval, neardup_threshold=0):
+        """Initializes the pipeline
+        batch_size:        number of buffered postings that triggers a write
+        flush_interval:    maximum time in seconds a posting stays buffered
+        neardup_threshold: similarity above which a posting is flagged as a near-duplicate, see neardup.NearDupIndex. 0 disables the detection. Default is 0"""
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.neardup_threshold = neardup_threshold
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getint('JUNTDB_BATCH_SIZE', 100), crawler.settings.getfloat('JUNTDB_FLUSH_INTERVAL', 60.0),\
+                   crawler.settings.getfloat('JUNTDB_NEARDUP_THRESHOLD', 0))
+
+    def open_spider(self, spider):
+        self.spider = spider
+        self.stages = crawler_stages(spider.crawler)
+        self.buffer = []
+        self.submitted = []
+        # Shared by all the spiders of the process, see juntdb.Writer
+        self.writer = juntdb.get_writer()
+        self.neardup = neardup.get_index(self.neardup_threshold) if self.neardup_threshold else None
+        self.flush_loop = task.LoopingCall(self.flush)
+        self.flush_loop.start(self.flush_interval, now=False)
+
+    def process_item(self, item, spider):
+        self.buffer.append(item)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        return item
+
+    def flush(self):
+        """Submits the buffered postings to the juntdb writer. The unique index on url_key discards the ones that were added by another spider in the meantime"""
+        if self.buffer:
+            rows, self.buffer = self.buffer, []
+            # The writer records the db stages of the batch in those of the crawler
+            with instrument.scope(self.stages):
+                if self.neardup is None:
+                    future = self.writer.add_many(rows, or_ignore=True)
+                else:
+                    # The near-duplicates are looked up by the writer thread, after the rows got their final dates
+                    future = self.writer.submit(self.neardup.add_many, rows, or_ignore=True)
+            self.submitted.append((rows, future))
+        self.collect()
+
+    def collect(self, wait=False):
+        """Counts the dupplicates and near-duplicates of the committed batches. A batch that failed is logged and counted in the failed_rows of the spider, and the crawl goes on
+        wait: if true, waits for all the submitted batches to be committed. Default is False"""
+        # The finished batches are removed first, such that a failed one is only reported once
+        finished, pending = [], []
+        for rows, future in self.submitted:
+            (finished if wait or future.done() else pending).append((rows, future))
+        self.submitted = pending
+        for rows, future in finished:
+            try:
+                inserted = future.result()
+            except Exception as e:
+                self.spider.failed_rows += len(rows)
+                logging.error('Failed to write a batch of ' + str(len(rows)) + ' postings: ' + repr(e) + '. Urls: ' +\
+                              ' '.join(str(item.get('url')) for item in rows))
+                continue
+            self.spider.dupp_count += len(rows) - inserted
+            self.spider.near_dupp_count += sum(item.get(neardup.DUPLICATE_COL) is not None for item in rows)
+
+    def close_spider(self, spider):
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush()
+        self.collect(wait=True)
+
+class InstrumentExtension:
+    """Scrapy extension feeding the downloads to instrument, as 'fetch/<domain>' stages. The stages of its own crawler are also kept apart: the downloads, and the page parsing and db writes of the spider and JuntdbPipeline, see crawler_stages. They are set in its stats collector when the spider closes. The stages of the whole process are only in the dump of lib.exec_crawl, since they are shared by the spiders of crawl_many"""
+    def __init__(self, stats):
+        self.stats = stats
+        self.stages = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not instrument.ENABLED:
+            raise NotConfigured
+        ext = cls(crawler.stats)
+        crawler.instrument_stages = ext.stages
+        crawler.signals.connect(ext.response_received, signal=scrapy.signals.response_received)
+        crawler.signals.connect(ext.spider_closed, signal=scrapy.signals.spider_closed)
+        return ext
+
+    def response_received(self, response, request, spider):
+        domain = urlparse(response.url).hostname
+        with instrument.scope(self.stages):
+            instrument.record('fetch/' + str(domain), request.meta.get('download_latency'))
+
+    def spider_closed(self, spider):
+        instrument.to_stats(self.stats, self.stages)
+
+def crawler_stages(crawler):
+    """Returns the dict of the instrument stages of the crawler, kept by InstrumentExtension, or None if it is not active"""
+    return getattr(crawler, 'instrument_stages', None)
+
+class DomainThrottle:
+    """Pacing of the requests to one domain, shared by all the spiders of a crawl. A request is let through by ThrottleScheduler when the domain has a free slot among its concurrency and the delay since the previous request elapsed"""
+    def __init__(self, domain, config):
+        """Initializes the throttle
+        domain: string of the domain
+        config: dict of the THROTTLE_* settings, see throttle_config"""
+        self.domain = domain
+        self.configure(config)
+        self.delay = min(max(config['THROTTLE_START_DELAY'], self.min_delay), self.max_delay)
+
+        self.active = 0
+        self.waiters = set()
+        self.next_send = 0.0
+        self.timer = None
+        self.backoffs = 0
+        self.retry_afters = 0
+
+        # Requests sent during each rate window: [(seconds since the start of the crawl, requests per second, delay)]
+        self.start = time.monotonic()
+        self.window_start = self.start
+        self.window_count = 0
+        self.rates = []
+
+    def configure(self, config):
+        self.config = config
+        self.concurrency = config['THROTTLE_DOMAIN_CONCURRENCY']
+        self.min_delay = config['THROTTLE_MIN_DELAY']
+        self.max_delay = config['THROTTLE_MAX_DELAY']
+        self.target_concurrency = config['THROTTLE_TARGET_CONCURRENCY']
+        self.backoff_delay = config['THROTTLE_BACKOFF_DELAY']
+        self.max_retry_after = config['THROTTLE_MAX_RETRY_AFTER']
+        self.rate_window = config['THROTTLE_RATE_WINDOW']
+
+    def merge(self, config):
+        """Tightens the throttle to the strictest of its settings and those of another spider class, see module.THROTTLE_STRICTEST
+        config: dict of the THROTTLE_* settings of the other spider class"""
+        merged = {key:THROTTLE_STRICTEST[key](value, config[key]) for key, value in self.config.items()}
+        # Called on every request of the other spiders, the delay is only raised once
+        if merged == self.config:
+            return
+        self.configure(merged)
+        start_delay = min(max(config['THROTTLE_START_DELAY'], self.min_delay), self.max_delay)
+        self.delay = min(max(self.delay, start_delay, self.min_delay), self.max_delay)
+
+    def try_acquire(self):
+        """Takes a slot if the domain is ready. The caller must call release once the request is downloaded
+
+        returns: true if the request can be sent now"""
+        now = time.monotonic()
+        if self.active >= self.concurrency or now < self.next_send:
+            return False
+        self.active += 1
+        self.next_send = now + self.delay
+        self.count_request(now)
+        return True
+
+    def wait(self, callback):
+        """Calls callback once, when the domain may be ready again"""
+        self.waiters.add(callback)
+        self.schedule()
+
+    def schedule(self):
+        """Calls the waiters if the domain has a free slot and the delay elapsed. Called again by a timer when the delay is not elapsed"""
+        if self.timer is not None and self.timer.active():
+            return
+        self.timer = None
+        if not self.waiters or self.active >= self.concurrency:
+            return
+        now = time.monotonic()
+        if now < self.next_send:
+            self.timer = reactor.callLater(self.next_send - now, self.schedule)
+            return
+        waiters, self.waiters = self.waiters, set()
+        for callback in waiters:
+            callback()
+
+    def release(self, status=None, latency=None, retry_after=None):
+        """Frees the slot of a downloaded request, and adapts the delay
+        status:      int of the http status, or None if the download failed. Default is None
+        latency:     download latency in seconds. Default is None
+        retry_after: seconds to wait before the next request, as asked by the server. Default is None"""
+        self.active -= 1
+        if status in (429, 503):
+            self.backoffs += 1
+            self.delay = min(self.max_delay, max(2*self.delay, self.backoff_delay))
+            if retry_after is not None:
+                self.retry_afters += 1
+                self.next_send = max(self.next_send, time.monotonic() + min(retry_after, self.max_retry_after))
+        elif status == 200 and latency is not None:
+            # Same rule as scrapy's AutoThrottle: halfway to the delay that keeps target_concurrency requests in flight
+            target = latency/self.target_concurrency
+            self.delay = min(self.max_delay, max(self.min_delay, (self.delay + target)/2))
+        self.schedule()
+
+    def count_request(self, now):
+        while now >= self.window_start + self.rate_window:
+            self.close_window()
+        self.window_count += 1
+
+    def close_window(self):
+        self.rates.append((round(self.window_start - self.start, 3), self.window_count/self.rate_window, round(self.delay, 4)))
+        self.window_start += self.rate_window
+        self.window_count = 0
+
+    def stats(self):
+        """Returns a dict of the current delay, the backoff counts and the request rates of the windows so far, the current one included"""
+        elapsed = time.monotonic() - self.window_start
+        rates = list(self.rates)
+        if self.window_count:
+            rates.append((round(self.window_start - self.start, 3), self.window_count/max(elapsed, 1e-3), round(self.delay, 4)))
+        return {'delay':self.delay, 'backoffs':self.backoffs, 'retry_afters':self.retry_afters, 'rate':rates}
+
+def parse_retry_after(value):
+    """Converts the Retry-After header of a response to seconds
+    value: bytes of the header, either seconds or an http date
+
+    returns: seconds to wait, or None if the header is missing or invalid"""
+    if not value:
+        return None
+    value = value.decode('latin-1').strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Throttles of the current crawl, by domain. Reset by crawl_one and crawl_many
+THROTTLES = {}
+
+def throttle_config(settings):
+    """Returns the dict of the float THROTTLE_* settings of a crawler, see module.PIPELINE_SETTINGS"""
+    config = {key:settings.getfloat(key) for key in THROTTLE_KEYS}
+    config['THROTTLE_DOMAIN_CONCURRENCY'] = int(config['THROTTLE_DOMAIN_CONCURRENCY'])
+    return config
+
+def request_domain(request):
+    return str(urlparse(request.url).hostname)
+
+def get_throttle(domain, config):
+    """Returns the DomainThrottle of the domain for the current crawl, creating it on first use. If the spiders of a crawl requesting the domain have different THROTTLE_* settings, the throttle takes the strictest ones
+    domain: string of the domain
+    config: output of throttle_config for the settings of the crawler"""
+    throttle = THROTTLES.get(domain)
+    if throttle is None:
+        throttle = THROTTLES[domain] = DomainThrottle(domain, config)
+    elif throttle.config != config:
+        throttle.merge(config)
+    return throttle
+
+class ThrottleScheduler(Scheduler):
+    """Scrapy scheduler letting the requests through the DomainThrottle of their domain. The requests of a domain that is not ready are parked here rather than in the downloader, such that they do not hold any of the CONCURRENT_REQUESTS slots while they wait, e.g. for a long Retry-After"""
+    def open(self, spider):
+        self.enabled = self.crawler.settings.getbool('THROTTLE_ENABLED')
+        self.config = throttle_config(self.crawler.settings) if self.enabled else None
+        self.parked = collections.OrderedDict() # domain -> deque of the requests waiting for the throttle
+        return super().open(spider)
+
+    def close(self, reason):
+        for domain in self.parked:
+            THROTTLES[domain].waiters.discard(self.wake)
+        return super().close(reason)
+
+    def __len__(self):
+        return super().__len__() + sum(len(x) for x in self.parked.values())
+
+    def enqueue_request(self, request):
+        if not self.enabled:
+            return super().enqueue_request(request)
+        domain = request_domain(request)
+        # Merges the settings of the spider in those of the domain before the request is queued
+        get_throttle(domain, self.config)
+        if request.meta.pop('throttle_wake', False):
+            self.parked.setdefault(domain, collections.deque()).appendleft(request)
+            return True
+        return super().enqueue_request(request)
+
+    def next_request(self):
+        if not self.enabled:
+            return super().next_request()
+        for domain, parked in self.parked.items():
+            if parked and self.acquire(domain, parked[0]):
+                return parked.popleft()
+        while True:
+            request = super().next_request()
+            if request is None:
+                return None
+            domain = request_domain(request)
+            if self.acquire(domain, request):
+                return request
+            self.parked.setdefault(domain, collections.deque()).append(request)
+
+    def acquire(self, domain, request):
+        """Takes a slot of the throttle of the domain for the request, or waits for it to be ready. ThrottleMiddleware releases the slot
+        returns: true if the request can be sent"""
+        throttle = THROTTLES[domain]
+        if throttle.try_acquire():
+            request.meta['throttled'] = True
+            return True
+        throttle.wait(self.wake)
+        return False
+
+    def wake(self):
+        """Makes the engine ask for the parked requests again. It only polls the scheduler when a download ends, or every few seconds, hence a parked request is sent back through engine.crawl"""
+        for parked in self.parked.values():
+            if parked:
+                request = parked.popleft()
+                request.meta['throttle_wake'] = True
+                self.crawler.engine.crawl(request)
+                return
+
+class ThrottleMiddleware:
+    """Downloader middleware releasing the DomainThrottle slot taken by ThrottleScheduler, with the status and latency of the response. It is the closest to the downloader, such that it sees every response, before the RetryMiddleware retries the 429 and 503"""
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.domains = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('THROTTLE_ENABLED'):
+            raise NotConfigured
+        mw = cls(crawler)
+        crawler.signals.connect(mw.spider_closed, signal=scrapy.signals.spider_closed)
+        return mw
+
+    def get_throttle(self, request):
+        domain = request_domain(request)
+        self.domains.add(domain)
+        return THROTTLES[domain]
+
+    def process_response(self, request, response, spider):
+        # Retried requests are copies of the meta, hence the pop
+        if request.meta.pop('throttled', False):
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            self.get_throttle(request).release(response.status, request.meta.get('download_latency'), retry_after)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        # The exception may come from an earlier middleware, after the slot was taken
+        if request.meta.pop('throttled', False):
+            self.get_throttle(request).release()
+
+    def spider_closed(self, spider):
+        """Sets the throttle stats of the domains requested by the spider"""
+        for domain in self.domains:
+            for key, value in THROTTLES[domain].stats().items():
+                self.crawler.stats.set_value('throttle/' + domain + '/' + key, value)
+
 def crawl_one(SpiderCls, *args, **kwargs):
     """Simple wrapper to crawl the specified spider
     SpiderCls: class of the spider
     args:      args to pass to the contructor of SpiderCls
     kwargs:    kwargs to pass to the constructor of SpiderCls"""
-    crawler = CrawlerProcess({
+    crawler = CrawlerProcess(dict(PIPELINE_SETTINGS, **{
        'USER_AGENT': 'Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1)',
        'LOG_LEVEL':'WARNING'
-    })
+    }))
+    global FRONTIER, THROTTLES
+    FRONTIER = UrlFrontier()
+    THROTTLES = {}
     crawler.crawl(SpiderCls, *args, **kwargs)
     crawler.start() # the script will block here until the crawling is finished
 
-def crawl_many(input_list):
+def crawl_many(input_list, settings=None):
     """Crawls in parallel the spiders specified in the input list
-    input list: list of tuples with (SpiderCls, args, kwargs). args and kwargs are passed to the constructor of SpiderCls"""
-    crawler = CrawlerProcess({
+    input list: list of tuples with (SpiderCls, args, kwargs). args and kwargs are passed to the constructor of SpiderCls
+    settings:   dict of scrapy settings overriding the defaults, e.g. CONCURRENT_REQUESTS. Default is None"""
+    crawler_settings = dict(PIPELINE_SETTINGS, **{
        'USER_AGENT': 'Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1)',
        'LOG_LEVEL':logging.INFO
     })
+    crawler_settings.update(settings or {})
+    crawler = CrawlerProcess(crawler_settings)
+    # Overlapping searches share the postings they find, see UrlFrontier
+    global FRONTIER, THROTTLES
+    FRONTIER = UrlFrontier()
+    THROTTLES = {}
     for spidercls, args, kwargs in input_list:
         crawler.crawl(spidercls, *args, **kwargs)
     crawler.start()